@@ -0,0 +1,130 @@
+#include "inc.h"
+
+static int checkShiftJIS(unsigned char first, unsigned char second)
+{
+    // Same rules as common.checkShiftJIS
+    if ((first >= 0x81 && first <= 0x84) || (first >= 0x87 && first <= 0x9f) || (first >= 0xe0 && first <= 0xef))
+        return second >= 0x40 && second <= 0xfc;
+    return 0;
+}
+
+static int scanString(unsigned char* data, Py_ssize_t datalength, Py_ssize_t pos, int ascii, unsigned char* table, Py_ssize_t* strend)
+{
+    // Mimic detectEncodedString/detectASCIIString, tracking the length of the decoded string and the UNK count
+    Py_ssize_t retlength = 0;
+    int unkcount = 0;
+    while (pos < datalength)
+    {
+        unsigned char b1 = data[pos++];
+        if (b1 == 0x0a)
+            ++retlength;
+        else if (b1 == 0x00)
+        {
+            *strend = pos - 1;
+            return retlength > 0;
+        }
+        else if (b1 >= 28 && b1 <= 126 && (ascii || retlength > 0 || b1 == 0x25))
+            ++retlength;
+        else if (ascii || pos >= datalength)
+            return 0;
+        else
+        {
+            unsigned char b2 = data[pos++];
+            if (checkShiftJIS(b1, b2))
+            {
+                // The table contains the decoded length of each pair, or 0 if it can't be decoded
+                int decodedlength = table[(b1 << 8) | b2];
+                if (decodedlength > 0)
+                    retlength += decodedlength;
+                else if (unkcount >= 5)
+                    return 0;
+                else
+                {
+                    retlength += 8;
+                    ++unkcount;
+                }
+            }
+            else if (retlength > 1 && unkcount < 5)
+            {
+                retlength += 8;
+                ++unkcount;
+            }
+            else
+                return 0;
+        }
+    }
+    return 0;
+}
+
+static PyObject* scanStrings(PyObject* m, PyObject* args, PyObject* kwargs)
+{
+    static char *kwlist[] = { "data", "start", "end", "ascii", "table", NULL };
+
+    Py_buffer data;
+    Py_buffer table;
+    Py_ssize_t start;
+    Py_ssize_t end;
+    int ascii;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "y*nnpy*", kwlist, &data, &start, &end, &ascii, &table))
+        return NULL;
+    if (!ascii && table.len < 0x10000)
+    {
+        PyBuffer_Release(&data);
+        PyBuffer_Release(&table);
+        PyErr_SetString(PyExc_ValueError, "Decode table must have 0x10000 entries");
+        return NULL;
+    }
+
+    PyObject* output = PyList_New(0);
+    if (output == NULL)
+    {
+        PyBuffer_Release(&data);
+        PyBuffer_Release(&table);
+        return NULL;
+    }
+    if (end > data.len)
+        end = data.len;
+    Py_ssize_t pos = start;
+    while (pos < end)
+    {
+        Py_ssize_t strend = 0;
+        if (scanString((unsigned char*)data.buf, data.len, pos, ascii, (unsigned char*)table.buf, &strend))
+        {
+            PyObject* span = Py_BuildValue("(nn)", pos, strend - pos);
+            if (span == NULL || PyList_Append(output, span) < 0)
+            {
+                Py_XDECREF(span);
+                Py_DECREF(output);
+                output = NULL;
+                break;
+            }
+            Py_DECREF(span);
+            pos = strend + 1;
+        }
+        else
+            ++pos;
+    }
+
+    PyBuffer_Release(&data);
+    PyBuffer_Release(&table);
+    return output;
+}
+
+static PyMethodDef Str_scanMethods[] = {
+    {"scanStrings", (PyCFunction)scanStrings, METH_VARARGS | METH_KEYWORDS, "Scan a buffer for null-terminated strings."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef str_scanmodule = {
+    PyModuleDef_HEAD_INIT,
+    "str_scan",
+    "String scanning functions.",
+    -1,
+    Str_scanMethods
+};
+
+PyMODINIT_FUNC PyInit_str_scan(void)
+{
+    return PyModule_Create(&str_scanmodule);
+}
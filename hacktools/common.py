@@ -1,8 +1,12 @@
+import array
+import bisect
 import codecs
+import collections
 from io import BytesIO, StringIO
 import xml.etree.ElementTree as ET
 import logging
 import math
+import mmap
 import os
 import re
 import shlex
@@ -10,12 +14,15 @@ import shutil
 import sys
 import struct
 import subprocess
+import time
 import typing
 import zlib
 
 hasClick = False
 hasTqdm = False
 hasGUI = False
+hasNumpy = False
+hasStrScan = False
 
 try:
     import click
@@ -29,38 +36,115 @@ try:
 except ImportError:
     pass
 
+try:
+    import numpy
+    hasNumpy = True
+except ImportError:
+    pass
+
+try:
+    from hacktools import str_scan
+    hasStrScan = True
+except ImportError:
+    pass
+
 table = {}
+iostats = None
+streamcodes = set()
 
 
 # File reading
 class Stream(object):
-    def __init__(self, fpath="", mode="m", little=True):
+    def __init__(self, fpath="", mode="m", little=True, buffered=False):
         self.f = fpath
         self.mode = mode
         self.endian = "<" if little else ">"
         self.half = None
+        self.file = None
+        self.view = None
+        self.buffered = buffered
+        self.buffer = None
+        self.buffersize = 0
 
     def __enter__(self):
         if self.mode == "m":
             self.f = BytesIO()
+        elif self.mode == "mmap" or self.mode == "mmap+":
+            # Map the file in memory, read functions will return memoryview slices instead of copies
+            self.file = open(self.f, "rb" if self.mode == "mmap" else "r+b")
+            if os.fstat(self.file.fileno()).st_size == 0:
+                # Empty files can't be mapped, just use the file directly
+                self.f = self.file
+                self.file = None
+            else:
+                self.f = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ if self.mode == "mmap" else mmap.ACCESS_WRITE)
+                self.view = memoryview(self.f)
         else:
             self.f = open(self.f, self.mode)
+        if self.buffered:
+            self.setBuffered(True)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.f.close()
+        self.close()
 
     def close(self):
-        self.f.close()
+        self.flush()
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+            try:
+                self.f.close()
+            except BufferError:
+                # Some returned slices are still alive, the mapping will be released with them
+                pass
+            self.file.close()
+        else:
+            self.f.close()
 
     def tell(self):
+        # The file position is always where the pending buffered writes will start
+        if self.buffer is not None:
+            return self.f.tell() + len(self.buffer)
         return self.f.tell()
 
     def seek(self, pos, whence=0):
+        self.flush()
+        start = time.perf_counter() if iostats is not None else 0
         self.f.seek(pos, whence)
+        if iostats is not None:
+            trackIO("seek", 0, start)
+
+    def isBuffered(self):
+        return self.buffer is not None
+
+    def setBuffered(self, buffered, buffersize=0x100000):
+        if buffered:
+            if self.buffer is None:
+                self.buffer = bytearray()
+            self.buffersize = buffersize
+        else:
+            self.flush()
+            self.buffer = None
+
+    def flush(self):
+        if self.buffer is not None and len(self.buffer) > 0:
+            self.f.write(self.buffer)
+            self.buffer = bytearray()
 
     def read(self, n=-1):
-        return self.f.read(n)
+        self.flush()
+        start = time.perf_counter() if iostats is not None else 0
+        if self.view is not None:
+            pos = self.f.tell()
+            end = len(self.view) if n < 0 else min(pos + n, len(self.view))
+            self.f.seek(end)
+            ret = self.view[pos:end]
+        else:
+            ret = self.f.read(n)
+        if iostats is not None:
+            trackIO("read", len(ret), start)
+        return ret
 
     def readAt(self, pos, n=-1):
         current = self.tell()
@@ -70,7 +154,15 @@ class Stream(object):
         return ret
 
     def write(self, data):
-        self.f.write(data)
+        start = time.perf_counter() if iostats is not None else 0
+        if self.buffer is not None:
+            self.buffer += data
+            if len(self.buffer) >= self.buffersize:
+                self.flush()
+        else:
+            self.f.write(data)
+        if iostats is not None:
+            trackIO("write", len(data), start)
 
     def writeAt(self, pos, data):
         current = self.tell()
@@ -85,7 +177,7 @@ class Stream(object):
         return ret
 
     def writeLine(self, data):
-        self.f.write(data + "\n")
+        self.write(data + "\n")
 
     def setEndian(self, little):
         self.endian = "<" if little else ">"
@@ -193,6 +285,25 @@ class Stream(object):
         self.seek(current)
         return ret
 
+    def readArray(self, typecode, count):
+        data = self.read(count * struct.calcsize(typecode))
+        if hasNumpy:
+            return numpy.frombuffer(data, self.endian + typecode).tolist()
+        ret = array.array(typecode, data)
+        if (self.endian == "<") != (sys.byteorder == "little"):
+            ret.byteswap()
+        return ret.tolist()
+
+    def readUShortArray(self, count):
+        return self.readArray("H", count)
+
+    def readUIntArray(self, count):
+        return self.readArray("I", count)
+
+    def readStructArray(self, fmt, count):
+        data = self.read(count * struct.calcsize(self.endian + fmt))
+        return list(struct.iter_unpack(self.endian + fmt, data))
+
     def readHalf(self):
         if self.half is None:
             self.half = self.readByte()
@@ -260,7 +371,7 @@ class Stream(object):
             else:
                 num += 1
         self.seek(pos)
-        ret = self.read(num).decode(encoding)
+        ret = bytes(self.read(num)).decode(encoding)
         self.readByte()
         return ret
 
@@ -272,7 +383,7 @@ class Stream(object):
         return ret
 
     def writeLong(self, num):
-        self.f.write(struct.pack(self.endian + "q", num))
+        self.write(struct.pack(self.endian + "q", num))
 
     def writeLongAt(self, pos, num):
         current = self.tell()
@@ -281,7 +392,7 @@ class Stream(object):
         self.seek(current)
 
     def writeULong(self, num):
-        self.f.write(struct.pack(self.endian + "Q", num))
+        self.write(struct.pack(self.endian + "Q", num))
 
     def writeULongAt(self, pos, num):
         current = self.tell()
@@ -290,7 +401,7 @@ class Stream(object):
         self.seek(current)
 
     def writeInt(self, num):
-        self.f.write(struct.pack(self.endian + "i", num))
+        self.write(struct.pack(self.endian + "i", num))
 
     def writeIntAt(self, pos, num):
         current = self.tell()
@@ -299,7 +410,7 @@ class Stream(object):
         self.seek(current)
 
     def writeUInt(self, num):
-        self.f.write(struct.pack(self.endian + "I", num))
+        self.write(struct.pack(self.endian + "I", num))
 
     def writeUIntAt(self, pos, num):
         current = self.tell()
@@ -308,7 +419,7 @@ class Stream(object):
         self.seek(current)
 
     def writeFloat(self, num):
-        self.f.write(struct.pack(self.endian + "f", num))
+        self.write(struct.pack(self.endian + "f", num))
 
     def writeFloatAt(self, pos, num):
         current = self.tell()
@@ -317,7 +428,7 @@ class Stream(object):
         self.seek(current)
 
     def writeDouble(self, num):
-        self.f.write(struct.pack(self.endian + "d", num))
+        self.write(struct.pack(self.endian + "d", num))
 
     def writeDoubleAt(self, pos, num):
         current = self.tell()
@@ -326,7 +437,7 @@ class Stream(object):
         self.seek(current)
 
     def writeShort(self, num):
-        self.f.write(struct.pack(self.endian + "h", num))
+        self.write(struct.pack(self.endian + "h", num))
 
     def writeShortAt(self, pos, num):
         current = self.tell()
@@ -335,7 +446,7 @@ class Stream(object):
         self.seek(current)
 
     def writeUShort(self, num):
-        self.f.write(struct.pack(self.endian + "H", num))
+        self.write(struct.pack(self.endian + "H", num))
 
     def writeUShortAt(self, pos, num):
         current = self.tell()
@@ -344,7 +455,14 @@ class Stream(object):
         self.seek(current)
 
     def writeByte(self, num):
-        self.f.write(struct.pack("B", num))
+        if iostats is not None:
+            self.write(struct.pack("B", num))
+        elif self.buffer is not None:
+            self.buffer.append(num)
+            if len(self.buffer) >= self.buffersize:
+                self.flush()
+        else:
+            self.f.write(struct.pack("B", num))
 
     def writeByteAt(self, pos, num):
         current = self.tell()
@@ -353,7 +471,7 @@ class Stream(object):
         self.seek(current)
 
     def writeSByte(self, num):
-        self.f.write(struct.pack("b", num))
+        self.write(struct.pack("b", num))
 
     def writeSByteAt(self, pos, num):
         current = self.tell()
@@ -361,6 +479,25 @@ class Stream(object):
         self.writeSByte(num)
         self.seek(current)
 
+    def writeArray(self, typecode, values):
+        if hasNumpy:
+            self.write(numpy.asarray(values, self.endian + typecode).tobytes())
+            return
+        data = array.array(typecode, values)
+        if (self.endian == "<") != (sys.byteorder == "little"):
+            data.byteswap()
+        self.write(data.tobytes())
+
+    def writeUShortArray(self, values):
+        self.writeArray("H", values)
+
+    def writeUIntArray(self, values):
+        self.writeArray("I", values)
+
+    def writeStructArray(self, fmt, values):
+        packer = struct.Struct(self.endian + fmt)
+        self.write(b"".join(packer.pack(*x) for x in values))
+
     def writeHalf(self, num, little=True):
         if self.half is None:
             self.half = num
@@ -372,20 +509,70 @@ class Stream(object):
             self.half = None
 
     def writeString(self, str):
-        self.f.write(str.encode("ascii"))
+        self.write(str.encode("ascii"))
 
     def writeZero(self, num):
         self.writeBytes(0x0, num)
 
     def writeBytes(self, byte, num):
         if num > 0:
-            for i in range(num):
-                self.writeByte(byte)
+            self.write(struct.pack("B", byte) * num)
 
     def truncate(self):
+        self.flush()
         self.f.truncate()
 
 
+# I/O statistics
+class IOStat:
+    def __init__(self):
+        self.reads = 0
+        self.readbytes = 0
+        self.writes = 0
+        self.writebytes = 0
+        self.seeks = 0
+        self.time = 0.0
+
+
+def enableIOStats(enabled=True):
+    global iostats, streamcodes
+    if enabled:
+        iostats = {}
+        streamcodes = set(x.__code__ for x in vars(Stream).values() if hasattr(x, "__code__"))
+    else:
+        iostats = None
+
+
+def trackIO(op, size, start):
+    elapsed = time.perf_counter() - start
+    # Find the first caller outside of Stream
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_code in streamcodes:
+        frame = frame.f_back
+    caller = "?" if frame is None else frame.f_globals.get("__name__", "?") + "." + frame.f_code.co_name
+    if caller not in iostats:
+        iostats[caller] = IOStat()
+    stat = iostats[caller]
+    stat.time += elapsed
+    if op == "read":
+        stat.reads += 1
+        stat.readbytes += size
+    elif op == "write":
+        stat.writes += 1
+        stat.writebytes += size
+    else:
+        stat.seeks += 1
+
+
+def logIOStats(top=20):
+    if iostats is None or len(iostats) == 0:
+        return
+    logMessage("I/O stats:")
+    stats = sorted(iostats.items(), key=lambda x: x[1].time, reverse=True)
+    for caller, stat in stats[:top]:
+        logMessage(" {0}: {1:.3f}s, {2} reads ({3} bytes), {4} writes ({5} bytes), {6} seeks".format(caller, stat.time, stat.reads, stat.readbytes, stat.writes, stat.writebytes, stat.seeks))
+
+
 # CLI/GUI
 if hasClick:
     appname = ""
@@ -408,9 +595,13 @@ if hasClick:
     @click.group(invoke_without_command=True)
     @click.option("--log", is_flag=True, default=False)
     @click.option("--gui", is_flag=True, default=False)
+    @click.option("--iostats", is_flag=True, default=False)
     @click.pass_context
-    def cli(ctx, log, gui):
+    def cli(ctx, log, gui, iostats):
         setupFileLogging(log)
+        if iostats:
+            enableIOStats()
+            ctx.call_on_close(logIOStats)
         if ctx.invoked_subcommand is None:
             multi = typing.cast(click.MultiCommand, ctx.command)
             ctx.invoke(multi.get_command(ctx, "main"), gui=gui)
@@ -570,6 +761,98 @@ def loadTable(tablefile):
                     table[linesplit[0]] = linesplit[1]
 
 
+class TableCodec:
+    def __init__(self, tablefile="", name="table"):
+        self.name = name
+        self.trie = {}
+        self.encodemap = {}
+        self.encodelengths = []
+        if tablefile != "":
+            with codecs.open(tablefile, "r", "utf-8") as ft:
+                for line in ft:
+                    line = line.strip("\r\n")
+                    if line.find("=") > 0:
+                        linesplit = line.split("=", 1)
+                        try:
+                            self.addEntry(bytes.fromhex(linesplit[0]), linesplit[1])
+                        except ValueError:
+                            logDebug("Skipping table line", line)
+
+    def addEntry(self, code, char):
+        # Decoding uses a trie to find the longest match, the value is stored with key -1
+        node = self.trie
+        for byte in code:
+            node = node.setdefault(byte, {})
+        node[-1] = char
+        # Empty values can be decoded, but can't be used to encode anything
+        if char != "" and char not in self.encodemap:
+            self.encodemap[char] = code
+            if len(char) not in self.encodelengths:
+                self.encodelengths.append(len(char))
+                self.encodelengths.sort(reverse=True)
+
+    def decode(self, input, errors="strict"):
+        ret = []
+        i = 0
+        while i < len(input):
+            node = self.trie
+            match = None
+            matchend = j = i
+            while j < len(input) and input[j] in node:
+                node = node[input[j]]
+                j += 1
+                if -1 in node:
+                    match = node[-1]
+                    matchend = j
+            if match is not None:
+                ret.append(match)
+                i = matchend
+            else:
+                error = UnicodeDecodeError(self.name, bytes(input), i, i + 1, "byte not in table")
+                replacement, i = codecs.lookup_error(errors)(error)
+                ret.append(replacement)
+        return "".join(ret), len(input)
+
+    def encode(self, input, errors="strict"):
+        ret = bytearray()
+        i = 0
+        while i < len(input):
+            for length in self.encodelengths:
+                if length > 0 and input[i:i + length] in self.encodemap:
+                    ret += self.encodemap[input[i:i + length]]
+                    i += length
+                    break
+            else:
+                error = UnicodeEncodeError(self.name, input, i, i + 1, "character not in table")
+                replacement, i = codecs.lookup_error(errors)(error)
+                ret += replacement if isinstance(replacement, bytes) else self.encode(replacement)[0]
+        return bytes(ret), len(input)
+
+
+tablecodecs = {}
+
+
+def findTableCodec(name):
+    name = name.lower().replace("-", "_").replace(" ", "_")
+    if name in tablecodecs:
+        return codecs.CodecInfo(tablecodecs[name].encode, tablecodecs[name].decode, name=name)
+    return None
+
+
+def loadTableCodec(tablefile, name=""):
+    codec = TableCodec(tablefile, name if name != "" else "table")
+    if name != "":
+        # Register the table so bytes.decode(name) and str.encode(name) can be used
+        # Python caches codec lookups, so a name can't be registered again with a different table
+        codecname = name.lower().replace("-", "_").replace(" ", "_")
+        if codecname in tablecodecs:
+            raise ValueError("Table codec " + name + " is already registered")
+        if len(tablecodecs) == 0:
+            codecs.register(findTableCodec)
+        tablecodecs[codecname] = codec
+    return codec
+
+
 def shiftPointer(pointer, pointerdiff):
     newpointer = pointer
     for k, v in pointerdiff.items():
@@ -580,6 +863,25 @@ def shiftPointer(pointer, pointerdiff):
     return newpointer
 
 
+class PointerShifter:
+    def __init__(self, pointerdiff):
+        self.keys = sorted(pointerdiff)
+        # offsets[i] is the total shift for pointers after the first i keys
+        self.offsets = [0]
+        for k in self.keys:
+            self.offsets.append(self.offsets[-1] + pointerdiff[k])
+
+    def shift(self, pointer):
+        return pointer + self.offsets[bisect.bisect_left(self.keys, pointer)]
+
+    def shiftMany(self, pointers):
+        if hasNumpy and len(self.keys) > 0:
+            pointers = numpy.asarray(pointers, dtype=numpy.int64)
+            indexes = numpy.searchsorted(numpy.asarray(self.keys, dtype=numpy.int64), pointers, side="left")
+            return (pointers + numpy.asarray(self.offsets, dtype=numpy.int64)[indexes]).tolist()
+        return [self.shift(pointer) for pointer in pointers]
+
+
 def checkShiftJIS(first, second):
     # Based on https://www.lemoda.net/c/detect-shift-jis/
     status = False
@@ -656,14 +958,95 @@ def getSection(f, title, comment="#", fixchars=[], justone=True, inorder=False):
 
 
 def getSections(file, comment="#", fixchars=[], inorder=False):
+    sectionfile = getSectionFile(file, comment, fixchars)
     sections = {}
-    with codecs.open(file, "r", "utf-8") as wsb:
-        files = getSectionNames(wsb)
-        for file in files:
-            sections[file] = getSection(wsb, file, comment, fixchars, inorder=inorder)
+    for name in sectionfile.names:
+        sections[name] = sectionfile.getSection(name, inorder)
     return sections
 
 
+class SectionFile:
+    def __init__(self, file="", comment="#", fixchars=[]):
+        self.comment = comment
+        self.fixchars = fixchars
+        self.names = []
+        self.sections = {"": {}}
+        self.ordered = {"": []}
+        self.translations = {}
+        if file != "":
+            with codecs.open(file, "r", "utf-8") as f:
+                self.parse(f)
+
+    def parse(self, f):
+        name = ""
+        section = self.sections[name]
+        ordered = self.ordered[name]
+        try:
+            for line in f:
+                line = line.rstrip("\r\n").replace("\ufeff", "")
+                if line.startswith("!FILE:"):
+                    name = line[6:].split("#")[0]
+                    if name not in self.sections:
+                        self.names.append(name)
+                        self.sections[name] = {}
+                        self.ordered[name] = []
+                        section = self.sections[name]
+                        ordered = self.ordered[name]
+                    else:
+                        # Like getSection, only the first section with the same name is used
+                        section = {}
+                        ordered = []
+                    continue
+                iscomment = line.startswith(self.comment)
+                if iscomment:
+                    ordered.append((line, None))
+                if line.find("=") > 0:
+                    split = line.split("=", 1)
+                    split[1] = split[1].split(self.comment)[0]
+                    for fixchar in self.fixchars:
+                        split[1] = split[1].replace(fixchar[0], fixchar[1])
+                    if split[0] not in section:
+                        section[split[0]] = []
+                    section[split[0]].append(split[1])
+                    if not iscomment:
+                        ordered.append((split[0], split[1]))
+        except UnicodeDecodeError:
+            pass
+        # Index the first translation of every string, skipping the lines before the first section
+        for name in self.names:
+            for check, values in self.sections[name].items():
+                if values[0] != "" and check not in self.translations:
+                    self.translations[check] = values[0]
+
+    def getSection(self, name="", inorder=False):
+        if name not in self.sections:
+            return {} if not inorder else []
+        if inorder:
+            return [{"name": x[0], "value": "" if x[1] is None else x[1]} for x in self.ordered[name]]
+        # Return a copy since callers pop the translations they use
+        return {k: list(v) for k, v in self.sections[name].items()}
+
+    def getTranslation(self, check):
+        if check in self.translations:
+            return self.translations[check]
+        return ""
+
+
+sectionfiles = {}
+
+
+def getSectionFile(file, comment="#", fixchars=[]):
+    # Cache a few parsed files until they are modified
+    key = (os.path.abspath(file), comment, tuple(tuple(x) for x in fixchars))
+    stat = os.stat(file)
+    mtime = (stat.st_mtime_ns, stat.st_size)
+    if key not in sectionfiles or sectionfiles[key][0] != mtime:
+        if len(sectionfiles) >= 8:
+            sectionfiles.clear()
+        sectionfiles[key] = (mtime, SectionFile(file, comment, fixchars))
+    return sectionfiles[key][1]
+
+
 def getSectionPercentage(section, chartot=0, transtot=0):
     for s in section.keys():
         strlen = len(s)
@@ -675,28 +1058,25 @@ def getSectionPercentage(section, chartot=0, transtot=0):
 
 
 def mergeSections(file1, file2, output, comment="#", fixchars=[]):
-    sections1 = getSections(file1, comment, fixchars, inorder=True)
-    sections2 = getSections(file2, comment, fixchars)
+    sections1 = getSectionFile(file1, comment, fixchars)
+    sections2 = getSectionFile(file2, comment, fixchars)
     with codecs.open(output, "w", "utf-8") as out:
-        for section in sections1.keys():
+        for section in sections1.names:
             out.write("!FILE:" + section + "\n")
-            for v in sections1[section]:
-                s = v["name"]
-                if s.startswith(comment):
+            for s, sectionstr in sections1.ordered[section]:
+                if sectionstr is None:
                     out.write(s + "\n")
                     continue
-                sectionstr = v["value"]
                 if sectionstr == "":
-                    for section2 in sections2.keys():
-                        if s in sections2[section2] and sections2[section2][s][0] != "":
-                            sectionstr = sections2[section2][s][0]
-                            break
+                    sectionstr = sections2.getTranslation(s)
                 out.write(s + "=" + sectionstr + "\n")
 
 
 class TranslationFile:
     def __init__(self, path=""):
         self.files = {}
+        self.ids = {}
+        self.sources = {}
         self.lookup = {}
         self.chartot = 0
         self.transtot = 0
@@ -705,29 +1085,69 @@ class TranslationFile:
             self.root.set("version", "1.2")
             self.root.set("xmlns", "urn:oasis:names:tc:xliff:document:1.2")
         else:
-            ET.register_namespace("", "urn:oasis:names:tc:xliff:document:1.2")
-            tree = ET.parse(path)
-            self.root = tree.getroot()
-            for file in self.root:
-                self.files[file.attrib["original"]] = file
+            self.load(path)
+
+    def load(self, path):
+        # Parse the file incrementally, only keeping the parts of each unit that we use
+        self.root = ET.Element("xliff")
+        for event, element in ET.iterparse(path, events=("start", "end")):
+            tag = element.tag.split("}")[-1]
+            if event == "start":
+                if tag == "xliff":
+                    self.root.set("version", element.get("version", "1.2"))
+                    self.root.set("xmlns", "urn:oasis:names:tc:xliff:document:1.2")
+                elif tag == "file":
+                    filename = element.attrib["original"]
+                    file = ET.SubElement(self.root, "file", element.attrib)
+                    ET.SubElement(file, "body")
+                    self.files[filename] = file
+                    if filename not in self.ids:
+                        self.ids[filename] = {}
+                        self.sources[filename] = {}
+                elif tag == "body":
+                    body = element
+            elif tag == "trans-unit":
+                unit = ET.SubElement(file[0], "trans-unit", element.attrib)
+                for child in element:
+                    if child.tag.split("}")[-1] in ["source", "target", "note"]:
+                        unit.append(self._copy_element(child))
+                if len(unit) < 2 or unit[1].tag != "target":
+                    unit.insert(1, ET.Element("target"))
+                self.indexUnit(filename, unit)
+                body.remove(element)
+
+    def _copy_element(self, element):
+        copy = ET.Element(element.tag.split("}")[-1], element.attrib)
+        copy.text = element.text
+        copy.tail = element.tail
+        for child in element:
+            copy.append(self._copy_element(child))
+        return copy
+
+    def indexUnit(self, filename, unit):
+        self.ids[filename].setdefault(unit.attrib["id"], []).append(unit)
+        self.sources[filename].setdefault(unit[0].text, []).append(unit)
 
     def mergeSection(self, path, filename="", section="", comments="#", fixchars=[]):
         with codecs.open(path, "r", "utf-8") as bin:
             mergesection = getSection(bin, section, comments, fixchars=fixchars, justone=False)
-        # Check the merge section
-        for file in self.root:
-            if filename != "" and file.attrib["original"] != filename:
+        # Check the merge section, multiple translations are assigned in the same order as the units
+        for file in self.sources:
+            if filename != "" and file != filename:
                 continue
-            for unit in file[0]:
-                check = unit[0].text
-                if check in mergesection and mergesection[check][0] != "":
+            for check, units in self.sources[file].items():
+                if check not in mergesection:
+                    continue
+                for unit in units:
+                    if mergesection[check][0] == "":
+                        break
                     newcheck = mergesection[check][0]
                     if len(mergesection[check]) > 1:
                         mergesection[check].pop(0)
                     unit[1].text = newcheck
                     unit[1].set("state", "translated")
                     unit.set("approved", "no")
-    
+
     def addEntry(self, text, filename, offset, translation="", comment=""):
         # Check if we need to add a new file
         if filename not in self.files:
@@ -737,6 +1157,8 @@ class TranslationFile:
             file.set("target-language", "en")
             ET.SubElement(file, "body")
             self.files[filename] = file
+            self.ids[filename] = {}
+            self.sources[filename] = {}
         else:
             file = self.files[filename]
         # Add the new entry
@@ -749,6 +1171,7 @@ class TranslationFile:
         if comment != "":
             note = ET.SubElement(unit, "note")
             note.text = comment
+        self.indexUnit(filename, unit)
 
     def preloadLookup(self):
         self.lookup = {}
@@ -765,12 +1188,12 @@ class TranslationFile:
         stroffset = str(offset)
         if filename in self.files:
             # Try to match offset
-            for unit in self.files[filename][0]:
-                if unit.attrib["id"] == stroffset and unit[1].text is not None and unit[1].text != "":
+            for unit in self.ids[filename].get(stroffset, []):
+                if unit[1].text is not None and unit[1].text != "":
                     return unit[1].text
             # Try to match string
-            for unit in self.files[filename][0]:
-                if unit[0].text == text and unit[1].text is not None and unit[1].text != "":
+            for unit in self.sources[filename].get(text, []):
+                if unit[1].text is not None and unit[1].text != "":
                     return unit[1].text
         # If nothing was found, run a search on the whole file
         if text in self.lookup:
@@ -789,12 +1212,24 @@ class TranslationFile:
         if dummy:
             self.addEntry("dummy line", "dummy", 0, "dummy translation", "Ignore this")
         makeFolders(os.path.dirname(filename))
-        self._pretty_print(self.root)
-        xmlstr = ET.tostring(self.root, encoding="unicode", xml_declaration=True)
-        # Change this to match what Weblate does
-        xmlstr = xmlstr.replace("<target />", "<target/>") + "\n"
+        # Write the units one at a time instead of serializing the whole tree
         with codecs.open(filename, "w", "utf-8") as f:
-            f.write(xmlstr)
+            f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+            f.write(self._start_tag(self.root) + "\n")
+            for file in self.root:
+                f.write("  " + self._start_tag(file) + "\n")
+                f.write("    <body>\n")
+                for unit in file[0]:
+                    self._pretty_print(unit, depth=3)
+                    unitstr = ET.tostring(unit, encoding="unicode")
+                    # Change this to match what Weblate does
+                    f.write("      " + unitstr.replace("<target />", "<target/>") + "\n")
+                f.write("    </body>\n")
+                f.write("  </file>\n")
+            f.write("</xliff>\n")
+
+    def _start_tag(self, element):
+        return ET.tostring(ET.Element(element.tag, element.attrib), encoding="unicode")[:-3] + ">"
 
     def _pretty_print(self, current, parent=None, index=-1, depth=0):
         for i, node in enumerate(current):
@@ -818,76 +1253,166 @@ class FontGlyph:
         self.index = index
 
 
-def wordwrap(text, glyphs, width, codefunc=None, default=6, linebreak="|", sectionsep=">>", strip=True):
-    # Based on http://code.activestate.com/recipes/577946-word-wrap-for-proportional-fonts/
-    lines = []
-    if sectionsep != "" and text.count(sectionsep) > 0:
-        lines = text.split(sectionsep)
-        for i in range(len(lines)):
-            lines[i] = wordwrap(lines[i], glyphs, width, codefunc, default, linebreak, sectionsep)
-        return sectionsep.join(lines)
-    if linebreak != "\n":
-        text = text.replace(linebreak, "\n")
-    pattern = re.compile(r"(\s+)")
-    lookup = dict((c, glyphs[c].length if c in glyphs else default) for c in set(text))
-    for line in text.splitlines():
-        tokens = pattern.split(line)
-        tokens.append("")
-        widths = []
-        for token in tokens:
-            tokenwidth = 0
+class WordWrapper:
+    def __init__(self, glyphs, width=0, codefunc=None, default=6, linebreak="|", sectionsep=">>", strip=True):
+        self.glyphs = glyphs
+        self.width = width
+        self.codefunc = codefunc
+        self.default = default
+        self.linebreak = linebreak
+        self.sectionsep = sectionsep
+        self.strip = strip
+        self.pattern = re.compile(r"(\s+)")
+        self.tokenwidths = {}
+
+    def getWidth(self, token):
+        if token in self.tokenwidths:
+            return self.tokenwidths[token]
+        glyphs = self.glyphs
+        tokenwidth = 0
+        if self.codefunc is None:
+            for c in token:
+                tokenwidth += glyphs[c].length if c in glyphs else self.default
+        else:
             i = 0
             while i < len(token):
-                if codefunc is not None:
-                    skip = codefunc(token, i)
-                    if skip > 0:
-                        i += skip
-                        continue
-                tokenwidth += lookup[token[i]]
-                i += 1
-            widths.append(tokenwidth)
-        start, total = 0, 0
-        for index in range(0, len(tokens), 2):
-            if total + widths[index] > width:
-                end = index + 2 if index == start else index
-                lines.append("".join(tokens[start:end]))
-                start, total = end, 0
-                if end == index + 2:
+                skip = self.codefunc(token, i)
+                if skip > 0:
+                    i += skip
                     continue
-            total += widths[index] + widths[index + 1]
-        if start < len(tokens):
-            lines.append("".join(tokens[start:]))
-    if strip:
-        lines = [line.strip() for line in lines]
-    else:
+                tokenwidth += glyphs[token[i]].length if token[i] in glyphs else self.default
+                i += 1
+        # Only remember a limited number of tokens, so the cache doesn't keep growing
+        if len(self.tokenwidths) >= 4096:
+            self.tokenwidths.clear()
+        self.tokenwidths[token] = tokenwidth
+        return tokenwidth
+
+    def wrap(self, text, width=0, strip=None):
+        # Based on http://code.activestate.com/recipes/577946-word-wrap-for-proportional-fonts/
+        if width == 0:
+            width = self.width
+        if strip is None:
+            strip = self.strip
+        if self.sectionsep != "" and text.count(self.sectionsep) > 0:
+            return self.sectionsep.join(self.wrap(x, width, True) for x in text.split(self.sectionsep))
+        lines = []
+        if self.linebreak != "\n":
+            text = text.replace(self.linebreak, "\n")
+        for line in text.splitlines():
+            tokens = self.pattern.split(line)
+            tokens.append("")
+            widths = [self.getWidth(token) for token in tokens]
+            start, total = 0, 0
+            for index in range(0, len(tokens), 2):
+                if total + widths[index] > width:
+                    end = index + 2 if index == start else index
+                    lines.append("".join(tokens[start:end]))
+                    start, total = end, 0
+                    if end == index + 2:
+                        continue
+                total += widths[index] + widths[index + 1]
+            if start < len(tokens):
+                lines.append("".join(tokens[start:]))
+        if strip:
+            lines = [line.strip() for line in lines]
+        else:
+            for i in range(len(lines)):
+                if lines[i].startswith(" "):
+                    lines[i] = lines[i][1:]
+                if lines[i].endswith(" "):
+                    lines[i] = lines[i][:-1]
+        return self.linebreak.join(lines)
+
+    def wrapMany(self, texts, width=0):
+        return [self.wrap(text, width) for text in texts]
+
+    def center(self, text, width=0, centercode="<<"):
+        if width == 0:
+            width = self.width
+        lines = text.split(self.linebreak)
         for i in range(len(lines)):
-            if lines[i].startswith(" "):
-                lines[i] = lines[i][1:]
-            if lines[i].endswith(" "):
-                lines[i] = lines[i][:-1]
-    return linebreak.join(lines)
+            if not lines[i].startswith(centercode):
+                continue
+            lines[i] = lines[i][len(centercode):]
+            length = self.getWidth(lines[i])
+            spacelen = self.glyphs[" "].length
+            spacing = int(((width - length) / 2) / spacelen)
+            lines[i] = (" " * spacing) + lines[i]
+        return self.linebreak.join(lines)
+
+
+def wordwrap(text, glyphs, width, codefunc=None, default=6, linebreak="|", sectionsep=">>", strip=True):
+    # Use a WordWrapper directly to reuse the token widths across many strings
+    return WordWrapper(glyphs, width, codefunc, default, linebreak, sectionsep, strip).wrap(text)
 
 
 def centerLines(text, glyphs, width, codefunc=None, default=6, linebreak="|", centercode="<<"):
-    lines = text.split(linebreak)
-    for i in range(len(lines)):
-        if not lines[i].startswith(centercode):
-            continue
-        lines[i] = lines[i][len(centercode):]
-        length = 0
-        j = 0
-        while j < len(lines[i]):
-            if codefunc is not None:
-                skip = codefunc(lines[i], j)
-                if skip > 0:
-                    j += skip
-                    continue
-            length += glyphs[lines[i][j]].length if lines[i][j] in glyphs else default
-            j += 1
-        spacelen = glyphs[" "].length
-        spacing = int(((width - length) / 2) / spacelen)
-        lines[i] = (" " * spacing) + lines[i]
-    return linebreak.join(lines)
+    return WordWrapper(glyphs, width, codefunc, default, linebreak).center(text, width, centercode)
+
+
+class TextOverflow:
+    def __init__(self, section, source, translation, line, width, maxwidth, linecount, maxlines):
+        self.section = section
+        self.source = source
+        self.translation = translation
+        self.line = line
+        self.width = width
+        self.maxwidth = maxwidth
+        self.linecount = linecount
+        self.maxlines = maxlines
+
+
+def getTranslations(translations):
+    if isinstance(translations, TranslationFile):
+        for filename in translations.files:
+            for unit in translations.files[filename][0]:
+                if unit[1].text is not None and unit[1].text != "":
+                    yield filename, unit[0].text, unit[1].text
+        return
+    if isinstance(translations, SectionFile):
+        translations = translations.sections
+    # Either a single section or a dictionary of sections
+    if len(translations) > 0 and isinstance(next(iter(translations.values())), dict):
+        sections = translations
+    else:
+        sections = {"": translations}
+    for name in sections:
+        for source in sections[name]:
+            for translation in sections[name][source]:
+                if translation != "":
+                    yield name, source, translation
+
+
+def checkOverflow(translations, glyphs, width, maxlines=0, codefunc=None, default=6, linebreak="|", sectionsep=">>", wrap=True):
+    # glyphs, width and maxlines can be dictionaries with per-section values, using "" as default
+    sectionglyphs = glyphs if len(glyphs) > 0 and isinstance(next(iter(glyphs.values())), dict) else {"": glyphs}
+    sectionwidths = width if isinstance(width, dict) else {"": width}
+    sectionlines = maxlines if isinstance(maxlines, dict) else {"": maxlines}
+    wrappers = {}
+    ret = []
+    for name, source, translation in getTranslations(translations):
+        glyphname = name if name in sectionglyphs else ""
+        if glyphname not in sectionglyphs:
+            raise ValueError("No glyphs for section " + name + " and no default \"\" glyphs")
+        if glyphname not in wrappers:
+            wrappers[glyphname] = WordWrapper(sectionglyphs[glyphname], 0, codefunc, default, linebreak, sectionsep)
+        wrapper = wrappers[glyphname]
+        maxwidth = sectionwidths[name] if name in sectionwidths else sectionwidths.get("", 0)
+        maxcount = sectionlines[name] if name in sectionlines else sectionlines.get("", 0)
+        text = wrapper.wrap(translation, maxwidth) if wrap and maxwidth > 0 else translation
+        boxes = text.split(sectionsep) if sectionsep != "" else [text]
+        for box in boxes:
+            lines = box.split(linebreak)
+            for i in range(len(lines)):
+                linewidth = wrapper.getWidth(lines[i])
+                overwidth = maxwidth > 0 and linewidth > maxwidth
+                overlines = maxcount > 0 and i >= maxcount
+                if overwidth or overlines:
+                    logDebug("Overflow in", name, "line", i, lines[i], "width", linewidth, "lines", len(lines))
+                    ret.append(TextOverflow(name, source, translation, lines[i], linewidth, maxwidth, len(lines), maxcount))
+    logMessage("Found", len(ret), "overflowing lines")
+    return ret
 
 
 def readEncodedString(f, encoding="shift_jis"):
@@ -909,7 +1434,7 @@ def readEncodedString(f, encoding="shift_jis"):
             else:
                 f.seek(-2, 1)
                 try:
-                    sjis += f.read(2).decode(encoding).replace("〜", "～")
+                    sjis += bytes(f.read(2)).decode(encoding).replace("〜", "～")
                 except UnicodeDecodeError:
                     logError("[ERROR] UnicodeDecodeError")
                     sjis += "[ERROR" + str(f.tell() - 2) + "]"
@@ -932,7 +1457,7 @@ def detectEncodedString(f, encoding="shift_jis", startascii=[0x25], startenc=[])
             if checkShiftJIS(b1, b2):
                 f.seek(-2, 1)
                 try:
-                    ret += f.read(2).decode(encoding).replace("〜", "～")
+                    ret += bytes(f.read(2)).decode(encoding).replace("〜", "～")
                     sjis += 1
                 except UnicodeDecodeError:
                     if ret.count("UNK(") >= 5:
@@ -960,60 +1485,132 @@ def detectASCIIString(f, encoding="ascii", startascii=[]):
     return ret
 
 
-def writeEncodedString(f, s, maxlen=0, encoding="shift_jis"):
+asciiencodings = {}
+
+
+def isASCIIEncoding(encoding):
+    if encoding not in asciiencodings:
+        asciicodes = bytes(range(128))
+        try:
+            asciiencodings[encoding] = asciicodes.decode("ascii").encode(encoding) == asciicodes
+        except (UnicodeError, LookupError):
+            asciiencodings[encoding] = False
+    return asciiencodings[encoding]
+
+
+def encodeString(s, maxlen=0, encoding="shift_jis"):
+    # Returns the length (or -1 if it doesn't fit) and the encoded data, without the terminator
+    s = s.replace("～", "〜")
+    fast = isASCIIEncoding(encoding)
+    ret = bytearray()
     i = 0
     x = 0
-    s = s.replace("～", "〜")
     while x < len(s):
-        c = s[x]
-        if c == "U" and x < len(s) - 4 and s[x:x+4] == "UNK(":
-            if maxlen > 0 and i+2 > maxlen:
-                return -1
-            code = s[x+4] + s[x+5]
-            f.write(bytes.fromhex(code))
-            code = s[x+6] + s[x+7]
-            f.write(bytes.fromhex(code))
-            x += 8
-            i += 2
-        elif c == "|":
-            if maxlen > 0 and i+1 > maxlen:
-                return -1
-            f.writeByte(0x0a)
-            i += 1
-        elif ord(c) < 128:
-            if maxlen > 0 and i+1 > maxlen:
-                return -1
-            f.writeByte(ord(c))
-            i += 1
+        unk = s.find("UNK(", x)
+        if unk >= len(s) - 4:
+            unk = -1
+        chunk = s[x:] if unk < 0 else s[x:unk]
+        # ASCII characters count as 1, everything else as 2
+        chunklen = 2 * len(chunk) - len(chunk.encode("ascii", "ignore"))
+        if fast and (maxlen == 0 or i + chunklen <= maxlen):
+            ret += chunk.replace("|", "\n").encode(encoding)
+            i += chunklen
         else:
-            if maxlen > 0 and i+2 > maxlen:
-                return -1
-            f.write(c.encode(encoding))
-            i += 2
-        x += 1
+            for c in chunk:
+                charlen = 1 if ord(c) < 128 else 2
+                if maxlen > 0 and i + charlen > maxlen:
+                    return -1, bytes(ret)
+                if c == "|":
+                    ret.append(0x0a)
+                elif charlen == 1:
+                    ret.append(ord(c))
+                else:
+                    ret += c.encode(encoding)
+                i += charlen
+        if unk < 0:
+            break
+        if maxlen > 0 and i + 2 > maxlen:
+            return -1, bytes(ret)
+        ret += bytes.fromhex(s[unk+4] + s[unk+5]) + bytes.fromhex(s[unk+6] + s[unk+7])
+        i += 2
+        x = unk + 9
+    return i, bytes(ret)
+
+
+def writeEncodedString(f, s, maxlen=0, encoding="shift_jis"):
+    i, data = encodeString(s, maxlen, encoding)
+    f.write(data)
+    if i < 0:
+        return -1
     f.writeByte(0x00)
     return i
 
 
+decodetables = {}
+
+
+def getDecodeTable(encoding):
+    if encoding not in decodetables:
+        # Decoded length of every Shift-JIS byte pair, 0 if the pair can't be decoded
+        decodetable = bytearray(0x10000)
+        for first in range(0x81, 0xf0):
+            for second in range(0x40, 0xfd):
+                if checkShiftJIS(first, second):
+                    try:
+                        decodetable[(first << 8) | second] = min(len(bytes([first, second]).decode(encoding)), 0xff)
+                    except UnicodeDecodeError:
+                        pass
+        decodetables[encoding] = bytes(decodetable)
+    return decodetables[encoding]
+
+
+def findBinaryStrings(f, binranges, func=detectEncodedString, encoding="shift_jis"):
+    f.seek(0, 2)
+    insize = f.tell()
+    # Use the native scanner to find candidates for the default detect functions
+    native = hasStrScan and (func is detectEncodedString or func is detectASCIIString)
+    if native:
+        f.seek(0)
+        data = f.read()
+        table = getDecodeTable(encoding) if func is detectEncodedString else b""
+    for binrange in binranges:
+        end = min(binrange[1], insize - 2)
+        pos = binrange[0]
+        spans = []
+        spanindex = 0
+        while pos < end:
+            if native:
+                if spanindex == len(spans):
+                    spans = str_scan.scanStrings(data, pos, end, func is detectASCIIString, table)
+                    spanindex = 0
+                    if len(spans) == 0:
+                        break
+                pos = spans[spanindex][0]
+                spanindex += 1
+            f.seek(pos)
+            check = func(f, encoding)
+            if check != "":
+                nextpos = f.tell()
+                yield pos, check
+                pos = nextpos
+            else:
+                # Rescan from the next byte if the scanner found a false positive
+                spans = []
+                spanindex = 0
+                pos += 1
+
+
 def extractBinaryStrings(infile, binranges, func=detectEncodedString, encoding="shift_jis"):
     strings = []
     positions = []
-    insize = os.path.getsize(infile)
     with Stream(infile, "rb") as f:
-        for binrange in binranges:
-            f.seek(binrange[0])
-            while f.tell() < binrange[1] and f.tell() < insize - 2:
-                pos = f.tell()
-                check = func(f, encoding)
-                if check != "":
-                    if check not in strings:
-                        logDebug("Found string at", pos)
-                        strings.append(check)
-                        positions.append([pos])
-                    else:
-                        positions[strings.index(check)].append(pos)
-                    pos = f.tell() - 1
-                f.seek(pos + 1)
+        for pos, check in findBinaryStrings(f, binranges, func, encoding):
+            if check not in strings:
+                logDebug("Found string at", pos)
+                strings.append(check)
+                positions.append([pos])
+            else:
+                positions[strings.index(check)].append(pos)
     return strings, positions
 
 
@@ -1024,109 +1621,221 @@ class BinaryPointer:
         self.str = str
 
 
-def repackBinaryStrings(section, infile, outfile, binranges, freeranges=None, readfunc=detectEncodedString, writefunc=writeEncodedString, encoding="shift_jis", pointerstart=0, injectstart=0, fallbackf=None, injectfallback=0, sectionname="bin"):
-    insize = os.path.getsize(infile)
-    notfound = []
+class FreeSpace:
+    def __init__(self, ranges=[], align=1):
+        self.align = align
+        self.starts = []
+        self.ranges = {}
+        self.sizes = []
+        for freerange in ranges:
+            # A third element marks ranges that use injectstart instead of pointerstart
+            self.free(freerange[0], freerange[1], len(freerange) == 3)
+
+    def addRange(self, start, end, injected):
+        if end <= start:
+            return
+        bisect.insort(self.starts, start)
+        self.ranges[start] = (end, injected)
+        bisect.insort(self.sizes, (end - start, start))
+
+    def removeRange(self, start):
+        end, injected = self.ranges.pop(start)
+        self.starts.pop(bisect.bisect_left(self.starts, start))
+        self.sizes.pop(bisect.bisect_left(self.sizes, (end - start, start)))
+        return end, injected
+
+    def free(self, start, end, injected=False):
+        if end <= start:
+            return
+        # Merge with the adjacent ranges of the same kind
+        i = bisect.bisect_left(self.starts, start)
+        if i > 0:
+            prevstart = self.starts[i - 1]
+            prevend, previnjected = self.ranges[prevstart]
+            if prevend >= start and previnjected == injected:
+                self.removeRange(prevstart)
+                start = prevstart
+                end = max(end, prevend)
+                i -= 1
+        while i < len(self.starts) and self.starts[i] <= end:
+            nextstart = self.starts[i]
+            nextend, nextinjected = self.ranges[nextstart]
+            if nextinjected != injected:
+                break
+            self.removeRange(nextstart)
+            end = max(end, nextend)
+        self.addRange(start, end, injected)
+
+    def alloc(self, size, align=0):
+        if align == 0:
+            align = self.align
+        # Best fit, look for the smallest range where the aligned data fits
+        i = bisect.bisect_left(self.sizes, (size,))
+        while i < len(self.sizes):
+            start = self.sizes[i][1]
+            alignedstart = start + (-start % align)
+            if alignedstart + size <= self.ranges[start][0]:
+                end, injected = self.removeRange(start)
+                self.addRange(start, alignedstart, injected)
+                self.addRange(alignedstart + size, end, injected)
+                return alignedstart, injected
+            i += 1
+        return -1, False
+
+    def getFreeBytes(self):
+        return sum(x[0] for x in self.sizes)
+
+    def getFragmentation(self):
+        total = self.getFreeBytes()
+        if total == 0:
+            return 0.0
+        return 1 - self.sizes[-1][0] / total
+
+
+class PointerIndex:
+    def __init__(self, data, align=4, little=True):
+        self.align = align
+        self.index = {}
+        endian = "<" if little else ">"
+        if align == 4:
+            values = struct.iter_unpack(endian + "I", data[:len(data) // 4 * 4])
+            for i, value in enumerate(values):
+                self.index.setdefault(value[0], []).append(i * 4)
+        else:
+            for offset in range(0, len(data) - 3, align):
+                value = struct.unpack_from(endian + "I", data, offset)[0]
+                self.index.setdefault(value, []).append(offset)
+
+    def find(self, value):
+        return self.index.get(value, [])
+
+
+class BinaryRepackPlan:
+    def __init__(self):
+        self.writes = []
+        self.fallback = []
+        self.pointers = []
+        self.notfound = []
+        self.freespace = None
+
+    def addWrite(self, offset, data):
+        self.writes.append((offset, data))
+
+    def apply(self, data, fallbackf=None):
+        for offset, writedata in self.writes:
+            data[offset:offset + len(writedata)] = writedata
+        if fallbackf is not None:
+            for offset, writedata in self.fallback:
+                fallbackf.seek(offset)
+                fallbackf.write(writedata)
+        return data
+
+
+def encodeBinaryString(writefunc, s, maxlen, encoding):
+    if writefunc is writeEncodedString:
+        length, data = encodeString(s, maxlen, encoding)
+        if length >= 0 or len(data) == 0 or data[-1] != 0:
+            data += b"\x00"
+        return length, data
+    with Stream() as f:
+        length = writefunc(f, s, maxlen, encoding)
+        if f.tell() == 0 or f.readByteAt(f.tell() - 1) != 0:
+            f.writeZero(1)
+        f.seek(0)
+        return length, f.read()
+
+
+def planBinaryStrings(section, infile, binranges, freeranges=None, readfunc=detectEncodedString, writefunc=writeEncodedString, encoding="shift_jis", pointerstart=0, injectstart=0, fallbackf=None, injectfallback=0, sectionname="bin", pointerindex=None):
+    plan = BinaryRepackPlan()
     with Stream(infile, "rb") as fi:
-        if freeranges is not None:
-            allbin = fi.read()
+        if freeranges is not None or injectfallback != 0:
+            if pointerindex is None:
+                pointerindex = PointerIndex(fi.read())
             strpointers = {}
-            freeranges = [list(x) for x in freeranges]
-        with Stream(outfile, "r+b") as fo:
-            for binrange in binranges:
-                fi.seek(binrange[0])
-                while fi.tell() < binrange[1] and fi.tell() < insize - 2:
-                    pos = fi.tell()
-                    check = readfunc(fi, encoding)
-                    if check != "":
-                        if isinstance(section, TranslationFile):
-                            newsjis = section.getEntry(check, sectionname, pos)
-                        else:
-                            newsjis = section[check][0] if check in section else ""
-                            if newsjis != "":
-                                if len(section[check]) > 1:
-                                    section[check].pop(0)
-                        if newsjis != "":
-                            if newsjis == "!":
-                                newsjis = ""
-                            newsjislog = newsjis.encode("ascii", "ignore")
-                            logDebug("Replacing string at", toHex(pos), "with", newsjislog)
-                            fo.seek(pos)
-                            endpos = fi.tell() - 1
-                            newlen = writefunc(fo, newsjis, endpos - pos + 1, encoding)
-                            fo.seek(-1, 1)
-                            if fo.readByte() != 0:
-                                fo.writeZero(1)
-                            if newlen < 0:
-                                if (freeranges is None and injectfallback == 0) or pointerstart == 0:
-                                    logError("String", newsjislog, "is too long.")
-                                else:
-                                    # Add this to the freeranges
-                                    freeranges.append([pos, endpos])
-                                    logDebug("Adding new freerage", toHex(pos), toHex(endpos))
-                                    range = None
-                                    rangelen = 0
-                                    for c in newsjis:
-                                        rangelen += 1 if ord(c) < 256 else 2
-                                    for freerange in freeranges:
-                                        if freerange[1] - freerange[0] > rangelen:
-                                            range = freerange
-                                            break
-                                    if range is None and newsjis not in strpointers and injectfallback == 0:
-                                        logError("No more room! Skipping", newsjislog, "...")
-                                        freeranges.pop()
-                                    else:
-                                        # Write the string in a new portion of the rom
-                                        if newsjis in strpointers:
-                                            newpointer = strpointers[newsjis]
-                                        elif range is None:
-                                            logDebug("No room for the string", newsjislog, ", redirecting to fallback")
-                                            fallbackpos = fallbackf.tell()
-                                            writefunc(fallbackf, newsjis, 0, encoding)
-                                            fallbackf.seek(-1, 1)
-                                            if fallbackf.readByte() != 0:
-                                                fallbackf.writeZero(1)
-                                            newpointer = injectfallback + fallbackpos
-                                            strpointers[newsjis] = newpointer
-                                        else:
-                                            logDebug("No room for the string", newsjislog, ", redirecting to", toHex(range[0]))
-                                            fo.seek(range[0])
-                                            writefunc(fo, newsjis, 0, encoding)
-                                            fo.seek(-1, 1)
-                                            if fo.readByte() != 0:
-                                                fo.writeZero(1)
-                                            newpointer = range[0]
-                                            # For the injected range, add injectstart, otherwise add pointerstart
-                                            if (len(range) == 3):
-                                                newpointer += injectstart
-                                            else:
-                                                newpointer += pointerstart
-                                            range[0] = fo.tell()
-                                            strpointers[newsjis] = newpointer
-                                        # Search and replace the old pointer
-                                        pointer = pointerstart + pos
-                                        pointersearch = struct.pack("<I", pointer)
-                                        index = 0
-                                        logDebug("Searching for pointer", toHex(pointer))
-                                        foundone = False
-                                        while index < len(allbin):
-                                            index = allbin.find(pointersearch, index)
-                                            if index < 0:
-                                                break
-                                            foundone = True
-                                            logDebug("Replaced pointer at", toHex(pointerstart + index), "with", toHex(newpointer))
-                                            fo.seek(index)
-                                            fo.writeUInt(newpointer)
-                                            index += 4
-                                        if not foundone:
-                                            logWarning("Pointer", toHex(pointer), "->", toHex(newpointer), "not found for string", newsjislog)
-                                            # freeranges.pop()
-                                            notfound.append(BinaryPointer(pointer, newpointer, newsjislog))
-                            else:
-                                fo.writeZero(endpos - fo.tell())
-                        pos = fi.tell() - 1
-                    fi.seek(pos + 1)
-    return notfound
+            if not isinstance(freeranges, FreeSpace):
+                freeranges = FreeSpace([] if freeranges is None else freeranges)
+            plan.freespace = freeranges
+            if fallbackf is not None:
+                fallbackpos = fallbackf.tell()
+        # Keep track of the next translation for each string here, instead of popping them from the section
+        sectionindex = {}
+        for pos, check in findBinaryStrings(fi, binranges, readfunc, encoding):
+            if isinstance(section, TranslationFile):
+                newsjis = section.getEntry(check, sectionname, pos)
+            elif check in section:
+                index = sectionindex.get(check, 0)
+                newsjis = section[check][index]
+                if newsjis != "" and index < len(section[check]) - 1:
+                    sectionindex[check] = index + 1
+            else:
+                newsjis = ""
+            if newsjis == "":
+                continue
+            if newsjis == "!":
+                newsjis = ""
+            newsjislog = newsjis.encode("ascii", "ignore")
+            logDebug("Replacing string at", toHex(pos), "with", newsjislog)
+            endpos = fi.tell() - 1
+            newlen, strdata = encodeBinaryString(writefunc, newsjis, endpos - pos + 1, encoding)
+            if newlen >= 0:
+                # Pad the rest of the old string with zeroes
+                strdata += b"\x00" * (endpos - pos - len(strdata))
+            plan.addWrite(pos, strdata)
+            if newlen >= 0:
+                continue
+            if (freeranges is None and injectfallback == 0) or pointerstart == 0:
+                logError("String", newsjislog, "is too long.")
+                continue
+            rangestart = -1
+            if newsjis not in strpointers:
+                newlen, strdata = encodeBinaryString(writefunc, newsjis, 0, encoding)
+                rangestart, injected = freeranges.alloc(len(strdata))
+            if rangestart < 0 and newsjis not in strpointers and injectfallback == 0:
+                logError("No more room! Skipping", newsjislog, "...")
+                continue
+            # Write the string in a new portion of the rom
+            if newsjis in strpointers:
+                newpointer = strpointers[newsjis]
+            elif rangestart < 0:
+                logDebug("No room for the string", newsjislog, ", redirecting to fallback")
+                plan.fallback.append((fallbackpos, strdata))
+                newpointer = injectfallback + fallbackpos
+                fallbackpos += len(strdata)
+                strpointers[newsjis] = newpointer
+            else:
+                logDebug("No room for the string", newsjislog, ", redirecting to", toHex(rangestart))
+                plan.addWrite(rangestart, strdata)
+                # For the injected range, add injectstart, otherwise add pointerstart
+                newpointer = rangestart + (injectstart if injected else pointerstart)
+                strpointers[newsjis] = newpointer
+            # Add this to the freeranges, the terminator is not needed anymore either
+            freeranges.free(pos, endpos + 1)
+            logDebug("Adding new freerange", toHex(pos), toHex(endpos + 1))
+            # Search and replace the old pointer
+            pointer = pointerstart + pos
+            logDebug("Searching for pointer", toHex(pointer))
+            foundone = False
+            for index in pointerindex.find(pointer):
+                foundone = True
+                logDebug("Replaced pointer at", toHex(pointerstart + index), "with", toHex(newpointer))
+                plan.pointers.append((index, pointer, newpointer))
+                plan.addWrite(index, struct.pack("<I", newpointer))
+            if not foundone:
+                logWarning("Pointer", toHex(pointer), "->", toHex(newpointer), "not found for string", newsjislog)
+                plan.notfound.append(BinaryPointer(pointer, newpointer, newsjislog))
+    if plan.freespace is not None:
+        logDebug("Free space left:", freeranges.getFreeBytes(), "bytes in", len(freeranges.starts), "ranges, fragmentation {0:.2f}%".format(100 * freeranges.getFragmentation()))
+    return plan
+
+
+def repackBinaryStrings(section, infile, outfile, binranges, freeranges=None, readfunc=detectEncodedString, writefunc=writeEncodedString, encoding="shift_jis", pointerstart=0, injectstart=0, fallbackf=None, injectfallback=0, sectionname="bin", pointerindex=None):
+    plan = planBinaryStrings(section, infile, binranges, freeranges, readfunc, writefunc, encoding, pointerstart, injectstart, fallbackf, injectfallback, sectionname, pointerindex)
+    with open(outfile, "rb") as f:
+        data = bytearray(f.read())
+    plan.apply(data, fallbackf)
+    with open(outfile, "wb") as f:
+        f.write(data)
+    return plan.notfound
 
 
 # Folders
@@ -1376,7 +2085,81 @@ def readRGB5A1(color):
     return (r, g, b, a)
 
 
-def getPaletteIndex(palette, color, fixtransp=False, starti=0, palsize=-1, checkalpha=False, zerotransp=True, backwards=False, logcolor=False):
+def readRGBA5650(color):
+    return ((color & 0x1f) << 3, ((color >> 5) & 0x3f) << 2, ((color >> 11) & 0x1f) << 3, 255)
+
+
+def readRGBA5551(color):
+    return ((color & 0x1f) << 3, ((color >> 5) & 0x1f) << 3, ((color >> 10) & 0x1f) << 3, (((color >> 15) & 0x1) << 7) + 127)
+
+
+def readRGBA4444(color):
+    return ((color & 0xf) * 0x11, ((color >> 4) & 0xf) * 0x11, ((color >> 8) & 0xf) * 0x11, ((color >> 12) & 0xf) * 0x11)
+
+
+def readRGB444(color):
+    return (((color >> 8) & 0xf) * 0x11, ((color >> 4) & 0xf) * 0x11, (color & 0xf) * 0x11, 0xff)
+
+
+colorformats = {
+    "BGR555": readPalette,
+    "RGB5A1": readRGB5A1,
+    "RGB5A3": readRGB5A3,
+    "RGBA5650": readRGBA5650,
+    "RGBA5551": readRGBA5551,
+    "RGBA4444": readRGBA4444,
+    "RGB444": readRGB444,
+}
+colortables = {}
+
+
+def getColorTable(format):
+    # Decode all the 16-bit values once, so colors can be decoded with a single lookup
+    if format not in colortables:
+        colortables[format] = [colorformats[format](x) for x in range(0x10000)]
+    return colortables[format]
+
+
+def decodeColors(data, format, little=True):
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        values = array.array("H", data[:len(data) // 2 * 2])
+        if little != (sys.byteorder == "little"):
+            values.byteswap()
+    else:
+        values = data
+    table = getColorTable(format)
+    return list(map(table.__getitem__, values))
+
+
+class ColorIndexCache:
+    def __init__(self, maxsize=0x1000):
+        self.maxsize = maxsize
+        self.palettes = {}
+
+    def getColors(self, palette, flags):
+        key = (id(palette),) + flags
+        cached = self.palettes.get(key)
+        # Keep a reference to the palette so its id can't be reused by another one
+        if cached is None or cached[0] is not palette:
+            cached = (palette, collections.OrderedDict())
+            self.palettes[key] = cached
+        return cached[1]
+
+    def addColor(self, colors, color, index):
+        colors[color] = index
+        if self.maxsize > 0 and len(colors) > self.maxsize:
+            colors.popitem(last=False)
+
+
+def getPaletteIndex(palette, color, fixtransp=False, starti=0, palsize=-1, checkalpha=False, zerotransp=True, backwards=False, logcolor=False, cache=None):
+    if cache is not None:
+        colors = cache.getColors(palette, (fixtransp, starti, palsize, checkalpha, zerotransp, backwards))
+        if color in colors:
+            colors.move_to_end(color)
+            return colors[color]
+        index = getPaletteIndex(palette, color, fixtransp, starti, palsize, checkalpha, zerotransp, backwards, logcolor)
+        cache.addColor(colors, color, index)
+        return index
     if zerotransp and color[3] == 0:
         return 0
     if palsize == -1:
@@ -1411,6 +2194,66 @@ def getPaletteIndex(palette, color, fixtransp=False, starti=0, palsize=-1, check
     return disti
 
 
+def getPaletteIndexes(palette, colors, fixtransp=False, starti=0, palsize=-1, checkalpha=False, zerotransp=True, backwards=False):
+    # Same as calling getPaletteIndex for every color, but only once per unique color
+    if palsize == -1:
+        palsize = len(palette)
+    if hasNumpy:
+        colors = numpy.asarray(colors, dtype=numpy.int64).reshape(-1, len(colors[0]) if len(colors) > 0 else 4)
+        if colors.shape[1] == 3:
+            colors = numpy.concatenate((colors, numpy.full((len(colors), 1), 255, dtype=numpy.int64)), 1)
+        keys = (colors[:, 0] << 24) | (colors[:, 1] << 16) | (colors[:, 2] << 8) | colors[:, 3]
+        keys, inverse = numpy.unique(keys, return_inverse=True)
+        uniquecolors = numpy.stack(((keys >> 24) & 0xff, (keys >> 16) & 0xff, (keys >> 8) & 0xff, keys & 0xff), 1)
+        indexes = quantizeColors(palette[starti:starti + palsize], uniquecolors, fixtransp, checkalpha, zerotransp, backwards)
+        return indexes[inverse.reshape(-1)].tolist()
+    cache = {}
+    ret = []
+    for color in colors:
+        color = tuple(color)
+        if color not in cache:
+            cache[color] = getPaletteIndex(palette, color, fixtransp, starti, palsize, checkalpha, zerotransp, backwards)
+        ret.append(cache[color])
+    return ret
+
+
+def quantizeColors(palette, colors, fixtransp=False, checkalpha=False, zerotransp=True, backwards=False):
+    palette = numpy.array([tuple(x) + (255,) * (4 - len(x)) for x in palette], dtype=numpy.int64)
+    ret = numpy.full(len(colors), -1, dtype=numpy.int64)
+    channels = 4 if checkalpha else 3
+    # Exact matches first, using a dictionary of the palette colors in search order
+    exact = {}
+    palrange = range(1 if fixtransp else 0, len(palette))
+    for i in (reversed(palrange) if backwards else palrange):
+        exact.setdefault(tuple(palette[i][:channels].tolist()), i)
+    for i, color in enumerate(colors.tolist()):
+        if zerotransp and color[3] == 0:
+            ret[i] = 0
+        elif tuple(color[:channels]) in exact:
+            ret[i] = exact[tuple(color[:channels])]
+        elif fixtransp and tuple(color[:channels]) == tuple(palette[0][:channels].tolist()):
+            ret[i] = 0
+    # Transparent colors use the last transparent palette color found
+    if checkalpha:
+        zeroalpha = [i for i in palrange if palette[i][3] == 0]
+        if len(zeroalpha) > 0:
+            ret[(ret == -1) & (colors[:, 3] == 0)] = zeroalpha[0] if backwards else zeroalpha[-1]
+    # Nearest color for everything else, in chunks to limit memory usage
+    missing = numpy.nonzero(ret == -1)[0]
+    if len(palette) == 1:
+        ret[missing] = 0
+        return ret
+    for chunk in range(0, len(missing), 0x1000):
+        chunkmissing = missing[chunk:chunk + 0x1000]
+        diff = colors[chunkmissing, None, :channels] - palette[None, 1:, :channels]
+        distances = (diff * diff).sum(2)
+        if backwards:
+            ret[chunkmissing] = len(palette) - 1 - numpy.argmin(distances[:, ::-1], 1)
+        else:
+            ret[chunkmissing] = 1 + numpy.argmin(distances, 1)
+    return ret
+
+
 def findBestPalette(palettes, colors):
     if len(palettes) == 1:
         return 0
@@ -1431,6 +2274,31 @@ def findBestPalette(palettes, colors):
     return disti
 
 
+def findBestPalettes(palettes, tiles):
+    # Same as calling findBestPalette for every tile, but distances are only computed once per unique color
+    if len(palettes) == 1:
+        return [0] * len(tiles)
+    if not hasNumpy or len(tiles) == 0:
+        return [findBestPalette(palettes, colors) for colors in tiles]
+    colors = numpy.array([[color[:3] for color in colors] for colors in tiles], dtype=numpy.int64)
+    keys = (colors[:, :, 0] << 16) | (colors[:, :, 1] << 8) | colors[:, :, 2]
+    keys, inverse = numpy.unique(keys, return_inverse=True)
+    uniquecolors = numpy.stack(((keys >> 16) & 0xff, (keys >> 8) & 0xff, keys & 0xff), 1)
+    distances = numpy.empty((len(palettes), len(tiles)))
+    for i in range(len(palettes)):
+        if len(palettes[i]) == 0:
+            distances[i] = 0xffffffff * colors.shape[1]
+            continue
+        palette = numpy.array([color[:3] for color in palettes[i]], dtype=numpy.int64)
+        mindist = numpy.empty(len(uniquecolors))
+        for chunk in range(0, len(uniquecolors), 0x1000):
+            diff = uniquecolors[chunk:chunk + 0x1000, None, :] - palette[None, :, :]
+            mindist[chunk:chunk + 0x1000] = numpy.sqrt((diff * diff).sum(2)).min(1)
+        # Sum the distances sequentially like findBestPalette does, so ties are resolved the same way
+        distances[i] = numpy.cumsum(mindist[inverse.reshape(colors.shape[:2])], 1)[:, -1]
+    return numpy.argmin(distances, 0).tolist()
+
+
 def drawPalette(pixels, palette, width, ystart=0, transp=True):
     for x in range(len(palette)):
         j = width + ((x % 8) * 5)
@@ -1444,6 +2312,169 @@ def drawPalette(pixels, palette, width, ystart=0, transp=True):
     return pixels
 
 
+# PSD files with RGBA layers
+# https://www.adobe.com/devnet-apps/photoshop/fileformatashtml/
+def writePSD(file, layers, composite):
+    composite = composite.convert("RGBA")
+    with Stream(file, "wb", False, buffered=True) as f:
+        f.writeString("8BPS")
+        f.writeUShort(1)
+        f.writeZero(6)
+        f.writeUShort(4)
+        f.writeUInt(composite.height)
+        f.writeUInt(composite.width)
+        f.writeUShort(8)
+        f.writeUShort(3)
+        # Color mode data and image resources
+        f.writeUInt(0)
+        f.writeUInt(0)
+        # Layer records, from the bottom layer to the top one
+        layerstart = f.tell()
+        f.writeUInt(0)
+        f.writeUInt(0)
+        f.writeShort(-len(layers))
+        channeldata = []
+        for name, image in layers:
+            image = image.convert("RGBA")
+            # Only store the non-transparent area of each layer
+            bbox = image.getchannel("A").getbbox()
+            if bbox is None:
+                bbox = (0, 0, 0, 0)
+                channels = [b"", b"", b"", b""]
+            else:
+                channels = [x.tobytes() for x in image.crop(bbox).split()]
+            f.writeInt(bbox[1])
+            f.writeInt(bbox[0])
+            f.writeInt(bbox[3])
+            f.writeInt(bbox[2])
+            f.writeUShort(4)
+            for channelid in [0, 1, 2, -1]:
+                f.writeShort(channelid)
+                f.writeUInt(2 + len(channels[channelid]))
+                channeldata.append(channels[channelid])
+            f.writeString("8BIMnorm")
+            f.write(bytes([255, 0, 0, 0]))
+            name = name.encode("latin-1", "replace")[:255]
+            namelen = (len(name) + 4) // 4 * 4
+            f.writeUInt(8 + namelen)
+            f.writeUInt(0)
+            f.writeUInt(0)
+            f.writeByte(len(name))
+            f.write(name)
+            f.writeZero(namelen - len(name) - 1)
+        for data in channeldata:
+            f.writeUShort(0)
+            f.write(data)
+        if (f.tell() - layerstart) % 2 == 1:
+            f.writeByte(0)
+        layerend = f.tell()
+        # Global layer mask info
+        f.writeUInt(0)
+        end = f.tell()
+        f.writeUIntAt(layerstart, end - layerstart - 4)
+        f.writeUIntAt(layerstart + 4, layerend - layerstart - 8)
+        f.seek(end)
+        # Merged image data
+        f.writeUShort(0)
+        for channel in composite.split():
+            f.write(channel.tobytes())
+
+
+def decompressPackBits(data):
+    ret = bytearray()
+    i = 0
+    while i < len(data):
+        n = data[i]
+        i += 1
+        if n < 128:
+            ret += data[i:i + n + 1]
+            i += n + 1
+        elif n > 128:
+            ret += data[i:i + 1] * (257 - n)
+            i += 1
+    return ret
+
+
+def readPSD(file):
+    try:
+        from PIL import Image
+    except ImportError:
+        logError("PIL not found")
+        return None
+    layers = []
+    with Stream(file, "rb", False) as f:
+        if f.read(4) != b"8BPS" or f.readUShort() != 1:
+            logError("Unsupported PSD file", file)
+            return None
+        f.seek(8, 1)
+        height = f.readUInt()
+        width = f.readUInt()
+        depth = f.readUShort()
+        mode = f.readUShort()
+        if depth != 8 or mode != 3:
+            logError("Unsupported PSD depth", depth, "or color mode", mode)
+            return None
+        # Skip color mode data and image resources
+        f.seek(f.readUInt(), 1)
+        f.seek(f.readUInt(), 1)
+        f.seek(4, 1)
+        if f.readUInt() == 0:
+            return layers
+        records = []
+        for i in range(abs(f.readShort())):
+            top = f.readInt()
+            left = f.readInt()
+            bottom = f.readInt()
+            right = f.readInt()
+            channels = []
+            for j in range(f.readUShort()):
+                channels.append((f.readShort(), f.readUInt()))
+            f.seek(12, 1)
+            extraend = f.readUInt()
+            extraend += f.tell()
+            # Skip mask and blending ranges
+            f.seek(f.readUInt(), 1)
+            f.seek(f.readUInt(), 1)
+            namelen = f.readByte()
+            name = f.read(namelen).decode("latin-1")
+            f.seek((namelen + 4) // 4 * 4 - namelen - 1, 1)
+            # Look for the unicode name in the additional layer information
+            while f.tell() + 12 <= extraend:
+                f.seek(4, 1)
+                key = f.read(4)
+                infoend = f.readUInt()
+                infoend += f.tell()
+                if key == b"luni":
+                    name = f.read(f.readUInt() * 2).decode("utf-16-be")
+                f.seek(infoend)
+            f.seek(extraend)
+            records.append((name, left, top, right - left, bottom - top, channels))
+        for name, left, top, layerwidth, layerheight, channels in records:
+            bands = {}
+            for channelid, length in channels:
+                end = f.tell() + length
+                if length >= 2 and channelid >= -1 and layerwidth > 0 and layerheight > 0:
+                    compression = f.readUShort()
+                    if compression == 0:
+                        data = f.read(layerwidth * layerheight)
+                    elif compression == 1:
+                        f.seek(layerheight * 2, 1)
+                        data = decompressPackBits(f.read(end - f.tell()))
+                    else:
+                        logError("Unsupported PSD compression", compression, "for layer", name)
+                        return None
+                    data = bytes(data[:layerwidth * layerheight]).ljust(layerwidth * layerheight, b"\x00")
+                    bands[channelid] = Image.frombytes("L", (layerwidth, layerheight), data)
+                f.seek(end)
+            # Draw each layer on a transparent image with the same size as the PSD
+            image = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+            if 0 in bands and 1 in bands and 2 in bands:
+                alpha = bands[-1] if -1 in bands else Image.new("L", (layerwidth, layerheight), 255)
+                image.paste(Image.merge("RGBA", (bands[0], bands[1], bands[2], alpha)), (left, top))
+            layers.append((name, image))
+    return layers
+
+
 def flipTile(tile, hflip, vflip, tilewidth=8, tileheight=8):
     newtile = [0] * len(tile)
     xrange = range(0, tilewidth) if not hflip else range(tilewidth - 1, -1, -1)
@@ -1454,3 +2485,19 @@ def flipTile(tile, hflip, vflip, tilewidth=8, tileheight=8):
             newtile[i] = tile[y * tileheight + x]
             i += 1
     return newtile
+
+
+class TileDict:
+    def __init__(self, tilewidth=8, tileheight=8):
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.tiles = {}
+
+    def add(self, tile, value):
+        # Index all the flipped variants, so lookups don't need to flip the searched tile
+        for hflip, vflip in [(False, False), (True, False), (False, True), (True, True)]:
+            flipped = tuple(flipTile(tile, hflip, vflip, self.tilewidth, self.tileheight))
+            self.tiles.setdefault(flipped, (value, hflip, vflip))
+
+    def find(self, tile):
+        return self.tiles.get(tuple(tile), (-1, False, False))
@@ -1,4 +1,5 @@
 import os
+import struct
 from enum import IntEnum
 from hacktools import common, cmp_cri
 
@@ -92,6 +93,21 @@ class UTFStructTypes(IntEnum):
     DATA_TYPE_NONE = -1
 
 
+UTFStructFormats = {
+    UTFStructTypes.DATA_TYPE_UINT8: "B",
+    UTFStructTypes.DATA_TYPE_INT8: "b",
+    UTFStructTypes.DATA_TYPE_UINT16: "H",
+    UTFStructTypes.DATA_TYPE_INT16: "h",
+    UTFStructTypes.DATA_TYPE_UINT32: "I",
+    UTFStructTypes.DATA_TYPE_INT32: "i",
+    UTFStructTypes.DATA_TYPE_UINT64: "Q",
+    UTFStructTypes.DATA_TYPE_INT64: "q",
+    UTFStructTypes.DATA_TYPE_FLOAT: "f",
+    UTFStructTypes.DATA_TYPE_STRING: "i",
+    UTFStructTypes.DATA_TYPE_BYTEARRAY: "ii",
+}
+
+
 class UTF:
     def __init__(self):
         self.columns = []
@@ -202,7 +218,7 @@ def extract(file, outfolder, guessextension=None):
     if len(cpk.filetable) == 0:
         common.logError("No files in CPK filetable")
         return
-    with common.Stream(file, "rb") as f:
+    with common.Stream(file, "mmap") as f:
         for entry in cpk.filetable:
             if entry.filetype != "FILE":
                 continue
@@ -214,9 +230,9 @@ def extract(file, outfolder, guessextension=None):
             if checkcomp == "CRILAYLA":
                 extractsize = entry.extractsize if entry.extractsize != 0 else entry.filesize
                 if extractsize != 0:
-                    data = cmp_cri.decompressCRILAYLA(data)
+                    data = cmp_cri.decompressCRILAYLA(bytes(data))
             if guessextension is not None:
-                filename = guessextension(data, entry, filename)
+                filename = guessextension(bytes(data), entry, filename)
             if not os.path.isdir(folder):
                 common.makeFolders(folder)
             with common.Stream(folder + filename, "wb") as fout:
@@ -595,8 +611,30 @@ def readUTF(f, baseoffset, storeraw=False):
         utf.columns.append(column)
         utf.columnlookup[column.name] = i
         common.logDebug("UTFColumn", i, vars(column))
+    # Build a struct format for the per-row columns and read all the rows at once
+    rowformat = ""
+    rowoffsets = []
+    for column in utf.columns:
+        if column.storagetype == UTFColumnFlags.STORAGE_PERROW:
+            rowoffsets.append(struct.calcsize(">" + rowformat))
+            rowformat += UTFStructFormats[column.flags & UTFColumnFlags.TYPE_MASK]
+    rowpadding = utf.rowlength - struct.calcsize(">" + rowformat)
+    if rowpadding > 0:
+        rowformat += str(rowpadding) + "x"
+    rowsdata = None
+    if rowpadding < 0:
+        common.logWarning("UTF row length", utf.rowlength, "is smaller than the columns size, reading rows one at a time")
+    elif rowformat != "" and utf.numrows > 0:
+        f.seek(utf.rowsoffset)
+        rowsdata = f.readStructArray(rowformat, utf.numrows)
     for j in range(utf.numrows):
-        f.seek(utf.rowsoffset + (j * utf.rowlength))
+        rowstart = utf.rowsoffset + (j * utf.rowlength)
+        if rowsdata is None:
+            f.seek(rowstart)
+        else:
+            rowdata = rowsdata[j]
+        datai = 0
+        perrowi = 0
         rows = []
         for i in range(utf.numcolumns):
             column = utf.columns[i]
@@ -605,12 +643,26 @@ def readUTF(f, baseoffset, storeraw=False):
                 row.data = 0
             elif column.storagetype == UTFColumnFlags.STORAGE_CONSTANT:
                 row.data = column.data
-            elif column.storagetype == UTFColumnFlags.STORAGE_PERROW:
+            elif column.storagetype == UTFColumnFlags.STORAGE_PERROW and rowsdata is None:
                 row.position = f.tell()
                 row.data, row.type = readUTFTypedData(f, utf, column.flags)
+            elif column.storagetype == UTFColumnFlags.STORAGE_PERROW:
+                row.position = rowstart + rowoffsets[perrowi]
+                row.type = column.flags & UTFColumnFlags.TYPE_MASK
+                perrowi += 1
+                if row.type == UTFStructTypes.DATA_TYPE_STRING:
+                    row.data = f.readNullStringAt(rowdata[datai] + utf.stringsoffset)
+                    datai += 1
+                elif row.type == UTFStructTypes.DATA_TYPE_BYTEARRAY:
+                    row.data = f.readAt(rowdata[datai] + utf.dataoffset, rowdata[datai + 1])
+                    datai += 2
+                else:
+                    row.data = rowdata[datai]
+                    datai += 1
             rows.append(row)
             # common.logDebug("UTFRow", j, i, column.name, vars(row))
         utf.rows.append(rows)
+    f.seek(utf.rowsoffset + (utf.numrows * utf.rowlength))
     return utf
 
 
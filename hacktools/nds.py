@@ -134,7 +134,7 @@ def extractBIN(binrange, readfunc=common.detectEncodedString, encoding="shift_ji
 
 
 def repackBIN(binrange, freeranges=[], readfunc=common.detectEncodedString, writefunc=common.writeEncodedString, encoding="shift_jis", comments="#",
-              binin="data/extract/arm9.bin", binout="data/repack/arm9.bin", binfile="data/bin_input.txt", fixchars=[], pointerstart=0x02000000, injectstart=0x02000000, fallbackf=None, injectfallback=0, nocopy=False, sectionname="bin"):
+              binin="data/extract/arm9.bin", binout="data/repack/arm9.bin", binfile="data/bin_input.txt", fixchars=[], pointerstart=0x02000000, injectstart=0x02000000, fallbackf=None, injectfallback=0, nocopy=False, sectionname="bin", pointerindex=None):
     if not os.path.isfile(binfile):
         common.logError("Input file", binfile, "not found")
         return False
@@ -144,15 +144,14 @@ def repackBIN(binrange, freeranges=[], readfunc=common.detectEncodedString, writ
     common.logMessage("Repacking BIN from", binfile, "...")
     section = {}
     if binfile.endswith(".txt"):
-        with codecs.open(binfile, "r", "utf-8") as bin:
-            section = common.getSection(bin, "", comments, fixchars=fixchars)
-            chartot, transtot = common.getSectionPercentage(section)
+        section = common.getSectionFile(binfile, comments, fixchars).getSection()
+        chartot, transtot = common.getSectionPercentage(section)
     else:
         section = common.TranslationFile(binfile)
         section.preloadLookup()
     if type(binrange) == tuple:
         binrange = [binrange]
-    notfound = common.repackBinaryStrings(section, binin, binout, binrange, freeranges, readfunc, writefunc, encoding, pointerstart, injectstart, fallbackf, injectfallback, sectionname)
+    notfound = common.repackBinaryStrings(section, binin, binout, binrange, freeranges, readfunc, writefunc, encoding, pointerstart, injectstart, fallbackf, injectfallback, sectionname, pointerindex)
     for pointer in notfound:
         common.logError("Pointer", common.toHex(pointer.old), "->", common.toHex(pointer.new), "not found for string", pointer.str)
     if binfile.endswith(".txt"):
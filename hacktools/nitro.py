@@ -1,9 +1,5 @@
 import math
 import os
-import shlex
-import shutil
-import subprocess
-import struct
 from hacktools import common
 
 
@@ -429,6 +425,116 @@ class NCGR:
         self.tiles = []
 
 
+class NCGRTile:
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return self.data[i].tolist()
+        return int(self.data[i])
+
+    def __setitem__(self, i, value):
+        self.data[i] = value
+
+    def __iter__(self):
+        return iter(self.data.tolist())
+
+    def __eq__(self, other):
+        return self.tolist() == list(other)
+
+    def __add__(self, other):
+        return self.tolist() + list(other)
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def index(self, value):
+        return self.tolist().index(value)
+
+    def tolist(self):
+        return self.data.tolist()
+
+
+class NCGRTiles:
+    def __init__(self, data):
+        self.array = data
+        self.count = len(data)
+
+    @property
+    def data(self):
+        return self.array[:self.count]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        # Tiles are views on the array, so changing their pixels changes the NCGR
+        if isinstance(i, slice):
+            return [NCGRTile(tile.reshape(-1)) for tile in self.data[i]]
+        return NCGRTile(self.data[i].reshape(-1))
+
+    def __setitem__(self, i, tile):
+        self.data[i] = self.toArray(tile)
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def __eq__(self, other):
+        return len(self) == len(other) and all(tile == othertile for tile, othertile in zip(self, other))
+
+    def __add__(self, other):
+        ret = NCGRTiles(self.data.copy())
+        ret.extend(other)
+        return ret
+
+    def toArray(self, tile):
+        if isinstance(tile, NCGRTile):
+            tile = tile.data
+        return common.numpy.array(tile, dtype=common.numpy.uint8).reshape(self.array.shape[1:])
+
+    def reserve(self, count):
+        # Keep some spare room at the end of the array, so appending tiles doesn't copy it every time
+        if count > len(self.array):
+            array = common.numpy.zeros((max(count, len(self.array) * 2),) + self.array.shape[1:], dtype=common.numpy.uint8)
+            array[:self.count] = self.data
+            self.array = array
+
+    def append(self, tile):
+        self.reserve(self.count + 1)
+        self.array[self.count] = self.toArray(tile)
+        self.count += 1
+
+    def extend(self, tiles):
+        tiles = [self.toArray(tile) for tile in tiles]
+        self.reserve(self.count + len(tiles))
+        for tile in tiles:
+            self.array[self.count] = tile
+            self.count += 1
+
+    def pop(self, i=-1):
+        if self.count == 0:
+            raise IndexError("pop from empty NCGRTiles")
+        if i < 0:
+            i += self.count
+        if i < 0 or i >= self.count:
+            raise IndexError("pop index out of range")
+        tile = self.array[i].reshape(-1).tolist()
+        self.array[i:self.count - 1] = self.array[i + 1:self.count].copy()
+        self.count -= 1
+        return tile
+
+    def index(self, tile):
+        found = common.numpy.flatnonzero((self.data == self.toArray(tile)).all(axis=(1, 2)))
+        if len(found) == 0:
+            raise ValueError("tile is not in NCGRTiles")
+        return int(found[0])
+
+
 class NSCR:
     def __init__(self):
         self.width = 0
@@ -544,16 +650,14 @@ def readNCLR(nclrfile, ignoreindex=False):
         # Read palettes
         f.seek(0x18 + offset)
         for i in range(pallen // (colornum * 2)):
-            palette = []
-            for j in range(colornum):
-                palette.append(common.readPalette(f.readUShort()))
+            palette = common.decodeColors(f.readUShortArray(colornum), "BGR555")
             palettes.append(palette)
         # Read index
         if sections == 2 and not ignoreindex:
             f.seek(16, 1)
             indexedpalettes = {}
-            for i in range(len(palettes)):
-                indexedpalettes[f.readUShort()] = palettes[i]
+            for i, index in enumerate(f.readUShortArray(len(palettes))):
+                indexedpalettes[index] = palettes[i]
         else:
             indexedpalettes = {i: palettes[i] for i in range(0, len(palettes))}
     common.logDebug("Loaded", len(indexedpalettes), "palettes")
@@ -587,16 +691,33 @@ def readNCGR(ncgrfile):
 
 
 def readNCGRTiles(ncgr, tiledata):
-    for i in range(ncgr.tilelen // (8 * ncgr.bpp)):
+    ncgr.tiles = unpackTiles(tiledata, ncgr.bpp, ncgr.tilelen // (8 * ncgr.bpp), ncgr.tilesize)
+
+
+def unpackTiles(tiledata, bpp, tilenum, tilesize=8):
+    if common.hasNumpy:
+        # Store the tiles as a (tilenum, tilesize, tilesize) array, unpacking nibbles for 4bpp
+        data = common.numpy.frombuffer(tiledata, dtype=common.numpy.uint8, count=(tilenum * tilesize * tilesize * bpp) // 8)
+        if bpp == 4:
+            unpacked = common.numpy.empty(len(data) * 2, dtype=common.numpy.uint8)
+            unpacked[0::2] = data & 0x0f
+            unpacked[1::2] = data >> 4
+            data = unpacked
+        else:
+            data = data.copy()
+        return NCGRTiles(data.reshape(tilenum, tilesize, tilesize))
+    tiles = []
+    for i in range(tilenum):
         singletile = []
-        for j in range(ncgr.tilesize * ncgr.tilesize):
-            x = i * (ncgr.tilesize * ncgr.tilesize) + j
-            if ncgr.bpp == 4:
+        for j in range(tilesize * tilesize):
+            x = i * (tilesize * tilesize) + j
+            if bpp == 4:
                 index = (tiledata[x // 2] >> ((x % 2) << 2)) & 0x0f
             else:
                 index = tiledata[x]
             singletile.append(index)
-        ncgr.tiles.append(singletile)
+        tiles.append(singletile)
+    return tiles
 
 
 def readNSCR(nscrfile):
@@ -608,10 +729,8 @@ def readNSCR(nscrfile):
         f.seek(4, 1)
         nscr.maplen = f.readUInt()
         nscr.mapoffset = f.tell()
-        mapdata = f.read(nscr.maplen)
         common.logDebug(vars(nscr))
-        for i in range(0, len(mapdata), 2):
-            data = struct.unpack("<h", mapdata[i:i+2])[0]
+        for data in f.readUShortArray(nscr.maplen // 2):
             submap = readMapData(data)
             nscr.maps.append(submap)
     common.logDebug("Loaded", len(nscr.maps), "maps")
@@ -762,37 +881,27 @@ def readNCER(ncerfile, ignoredupes=False):
             if bank.cellnum > 0:
                 bank.layernum = 1
                 cells[0].layer = 0
-                if len(cells) > 1:
-                    for j in range(1, len(cells)):
-                        cell = cells[j]
-                        # For every other cell in the current layer, check if it's intersected
-                        hit = False
-                        for layercheck in cells:
-                            if cell != layercheck and layercheck.layer == bank.layernum - 1:
-                                if cellIntersect(cell, layercheck):
-                                    hit = True
-                                    break
-                        if hit:
-                            # All layers are full, make a new one
-                            cells[j].layer = bank.layernum
-                            bank.layernum += 1
-                        else:
-                            cells[j].layer = bank.layernum - 1
-    # Mark banks as duplicate
+                layergrid = CellGrid()
+                layergrid.add(cells[0])
+                for j in range(1, len(cells)):
+                    # Only the cells in the current layer need to be checked for intersections
+                    if layergrid.intersects(cells[j]):
+                        # All layers are full, make a new one
+                        cells[j].layer = bank.layernum
+                        bank.layernum += 1
+                        layergrid = CellGrid()
+                    else:
+                        cells[j].layer = bank.layernum - 1
+                    layergrid.add(cells[j])
+    # Mark banks as duplicate, keeping the first bank with the same cells
     if not ignoredupes:
+        banksignatures = set()
         for bank in ncer.banks:
-            if bank.duplicate:
-                continue
-            for bank2 in ncer.banks:
-                if bank2.duplicate or bank == bank2 or bank.cellnum != bank2.cellnum:
-                    continue
-                samecells = True
-                for i in range(bank.cellnum):
-                    if bank.cells[i].width != bank2.cells[i].width or bank.cells[i].height != bank2.cells[i].height or bank.cells[i].tileoffset != bank2.cells[i].tileoffset:
-                        samecells = False
-                        break
-                if samecells:
-                    bank2.duplicate = True
+            signature = tuple((cell.width, cell.height, cell.tileoffset) for cell in bank.cells)
+            if signature in banksignatures:
+                bank.duplicate = True
+            else:
+                banksignatures.add(signature)
     common.logDebug("Loaded", len(ncer.banks), "banks")
     return ncer
 
@@ -801,9 +910,33 @@ def cellIntersect(a, b):
     return (a.x < b.x + b.width) and (a.x + a.width > b.x) and (a.y < b.y + b.height) and (a.y + a.height > b.y)
 
 
+class CellGrid:
+    def __init__(self, gridsize=32):
+        self.gridsize = gridsize
+        self.grid = {}
+
+    def getKeys(self, cell):
+        # Empty cells can still intersect other cells, so they always cover their starting position
+        for x in range(cell.x // self.gridsize, max(cell.x, cell.x + cell.width - 1) // self.gridsize + 1):
+            for y in range(cell.y // self.gridsize, max(cell.y, cell.y + cell.height - 1) // self.gridsize + 1):
+                yield (x, y)
+
+    def add(self, cell):
+        for key in self.getKeys(cell):
+            self.grid.setdefault(key, []).append(cell)
+
+    def intersects(self, cell):
+        for key in self.getKeys(cell):
+            for gridcell in self.grid.get(key, []):
+                if gridcell is not cell and cellIntersect(cell, gridcell):
+                    return True
+        return False
+
+
 def tileToPixels(pixels, width, ncgr, tile, xflip, yflip, i, j, palette, pali, usetransp=True):
     try:
-        tiledata = ncgr.tiles[tile]
+        # Convert the tile once, instead of going through NCGRTile for every pixel
+        tiledata = list(ncgr.tiles[tile])
     except IndexError:
         common.logWarning("Unable to get tile", tile)
         return pixels
@@ -827,6 +960,65 @@ def tileToPixels(pixels, width, ncgr, tile, xflip, yflip, i, j, palette, pali, u
     return pixels
 
 
+def tilesToArray(canvas, width, height, ncgr, nscr, palettes, usetransp=True):
+    numpy = common.numpy
+    tilesize = ncgr.tilesize
+    cols = width // tilesize
+    count = (height // tilesize) * cols
+    if isinstance(ncgr.tiles, NCGRTiles):
+        tiles = ncgr.tiles.data
+    else:
+        tiles = numpy.array(ncgr.tiles, dtype=numpy.uint8).reshape(-1, tilesize, tilesize)
+    # Put all the palettes in a single array, so the colors can be looked up at once
+    paloffsets = {}
+    palcolors = []
+    for key, palette in palettes.items():
+        paloffsets[key] = len(palcolors)
+        palcolors += [tuple(color) + (255,) * (4 - len(color)) for color in palette]
+    palcolors = numpy.array(palcolors, dtype=numpy.uint8).reshape(-1, 4)
+    if nscr is not None:
+        maps = [nscr.maps[x] for x in range(count)]
+    else:
+        maps = [Map() for x in range(count)]
+        for x in range(count):
+            maps[x].tile = x
+    tileids = numpy.array([map.tile for map in maps], dtype=numpy.int64)
+    palstart = numpy.empty(count, dtype=numpy.int64)
+    palend = numpy.empty(count, dtype=numpy.int64)
+    for x in range(count):
+        pal = maps[x].pal if maps[x].pal in palettes.keys() else 0
+        pali = 0 if maps[x].pal in palettes.keys() else maps[x].pal * 16
+        palstart[x] = paloffsets[pal] + pali
+        palend[x] = paloffsets[pal] + len(palettes[pal])
+    for x in numpy.nonzero(tileids >= len(tiles))[0]:
+        common.logWarning("Unable to get tile", tileids[x])
+    positions = numpy.nonzero(tileids < len(tiles))[0]
+    # Gather the tiles and flip them with reversed views
+    tiledata = tiles[tileids[positions]].astype(numpy.int64)
+    xflip = numpy.array([maps[x].xflip for x in positions], dtype=bool)
+    yflip = numpy.array([maps[x].yflip for x in positions], dtype=bool)
+    tiledata[xflip] = tiledata[xflip][:, :, ::-1]
+    tiledata[yflip] = tiledata[yflip][:, ::-1, :]
+    i = (positions // cols)[:, None, None]
+    j = (positions % cols)[:, None, None]
+    i2, j2 = numpy.mgrid[0:tilesize, 0:tilesize]
+    if ncgr.lineal:
+        lineal = (i * width * tilesize) + (j * tilesize * tilesize) + (i2 * tilesize + j2)
+        pixelx = lineal % width
+        pixely = lineal // width
+    else:
+        pixelx = j * tilesize + j2
+        pixely = i * tilesize + i2
+    colorindex = palstart[positions][:, None, None] + tiledata
+    drawn = (tiledata > 0) if usetransp else numpy.ones(tiledata.shape, dtype=bool)
+    valid = (colorindex < palend[positions][:, None, None]) & (pixely < canvas.shape[0])
+    for x in numpy.nonzero((drawn & ~valid).any((1, 2)))[0]:
+        common.logWarning("Unable to set pixels at", i[x, 0, 0], j[x, 0, 0], "for tile", tileids[positions[x]], "with palette", maps[positions[x]].pal)
+    drawn &= valid
+    canvas[pixely[drawn], pixelx[drawn]] = palcolors[colorindex[drawn]]
+    return canvas
+
+
 def drawNCER(outfile, ncer, ncgr, palettes, usetransp=True, layered=False):
     try:
         from PIL import Image
@@ -860,7 +1052,7 @@ def drawNCER(outfile, ncer, ncgr, palettes, usetransp=True, layered=False):
         layered = not allone
     # Save just the palette as a separate layer
     if layered:
-        img.save(outfile, "PNG")
+        layers.append(("palette", img.copy()))
     # Loop and draw the banks
     currheight = 0
     for bankn in range(len(ncer.banks)):
@@ -891,27 +1083,12 @@ def drawNCER(outfile, ncer, ncgr, palettes, usetransp=True, layered=False):
             img.paste(cellimg, (cell.x, currheight + cell.y), cellimg)
         if layered:
             for i in range(bank.layernum):
-                layerfile = outfile.replace(".png", "_" + str(bankn) + "_" + str(i) + ".png")
-                banklayers[i].save(layerfile, "PNG")
-                layers.append(layerfile)
+                layername = os.path.basename(outfile).replace(".png", "") + "_" + str(bankn) + "_" + str(i)
+                layers.append((layername, banklayers[i]))
         currheight += bank.height
-    magickcmd = ""
-    if os.path.isfile("magick"):
-        magickcmd = "./magick"
-    elif shutil.which("magick"):
-        magickcmd = shutil.which("magick")
-    if layered and magickcmd != "":
-        with open("script.scr", "w") as script:
-            script.write("\"" + outfile + "\" -label \"palette\" -background none -mosaic -set colorspace RGBA")
-            for layer in layers:
-                script.write(" ( -page +0+0 -label \"" + os.path.basename(layer).replace(".png", "") + "\" \"" + layer + "\"[0] -background none -mosaic -set colorspace RGBA )")
-            script.write(" ( -clone 0--1 -background none -mosaic ) -reverse -write \"" + outfile.replace(".png", ".psd") + "\"")
-        cmd = magickcmd + " -script script.scr"
-        common.execute(cmd, False)
-        for layer in layers:
-            os.remove(layer)
-        os.remove(outfile)
-        os.remove("script.scr")
+    if layered:
+        layers.reverse()
+        common.writePSD(outfile.replace(".png", ".psd"), layers, img)
     img.save(outfile, "PNG")
 
 
@@ -932,23 +1109,30 @@ def drawNCGR(outfile, nscr, ncgr, palettes, width, height, usetransp=True):
     palsize = 0
     for palette in palettes.values():
         palsize += 5 * (len(palette) // 8)
-    img = Image.new("RGBA", (width + 40, max(height, palsize)), (0, 0, 0, 0))
-    pixels = img.load()
-    x = 0
-    for i in range(height // ncgr.tilesize):
-        for j in range(width // ncgr.tilesize):
-            if nscr is not None:
-                map = nscr.maps[x]
-                if map.pal in palettes.keys():
-                    pali = 0
-                    palette = palettes[map.pal]
+    if common.hasNumpy:
+        canvas = common.numpy.zeros((max(height, palsize), width + 40, 4), dtype=common.numpy.uint8)
+        tilesToArray(canvas, width, height, ncgr, nscr, palettes, usetransp)
+        # Copy the image since fromarray shares the read-only array memory
+        img = Image.fromarray(canvas, "RGBA").copy()
+        pixels = img.load()
+    else:
+        img = Image.new("RGBA", (width + 40, max(height, palsize)), (0, 0, 0, 0))
+        pixels = img.load()
+        x = 0
+        for i in range(height // ncgr.tilesize):
+            for j in range(width // ncgr.tilesize):
+                if nscr is not None:
+                    map = nscr.maps[x]
+                    if map.pal in palettes.keys():
+                        pali = 0
+                        palette = palettes[map.pal]
+                    else:
+                        pali = map.pal * 16
+                        palette = palettes[0]
+                    pixels = tileToPixels(pixels, width, ncgr, map.tile, map.xflip, map.yflip, i, j, palette, pali, usetransp)
                 else:
-                    pali = map.pal * 16
-                    palette = palettes[0]
-                pixels = tileToPixels(pixels, width, ncgr, map.tile, map.xflip, map.yflip, i, j, palette, pali, usetransp)
-            else:
-                pixels = tileToPixels(pixels, width, ncgr, x, False, False, i, j, palettes[0], 0, usetransp)
-            x += 1
+                    pixels = tileToPixels(pixels, width, ncgr, x, False, False, i, j, palettes[0], 0, usetransp)
+                x += 1
     palstart = 0
     for palette in palettes.values():
         pixels = common.drawPalette(pixels, palette, width, palstart * 10)
@@ -964,7 +1148,7 @@ def writeNCGRData(f, bpp, index1, index2):
         f.writeByte(index2)
 
 
-def writeNCGRTile(f, pixels, width, ncgr, i, j, palette):
+def writeNCGRTile(f, pixels, width, ncgr, i, j, palette, cache=None):
     for i2 in range(ncgr.tilesize):
         for j2 in range(0, ncgr.tilesize, 2):
             if ncgr.lineal:
@@ -974,8 +1158,8 @@ def writeNCGRTile(f, pixels, width, ncgr, i, j, palette):
             else:
                 pixelx = j * ncgr.tilesize + j2
                 pixely = i * ncgr.tilesize + i2
-            index1 = common.getPaletteIndex(palette, pixels[pixelx, pixely])
-            index2 = common.getPaletteIndex(palette, pixels[pixelx + 1, pixely])
+            index1 = common.getPaletteIndex(palette, pixels[pixelx, pixely], cache=cache)
+            index2 = common.getPaletteIndex(palette, pixels[pixelx + 1, pixely], cache=cache)
             writeNCGRData(f, ncgr.bpp, index1, index2)
 
 
@@ -991,11 +1175,12 @@ def writeNCGR(file, ncgr, infile, palettes, width=-1, height=-1):
     img = Image.open(infile)
     img = img.convert("RGBA")
     pixels = img.load()
-    with common.Stream(file, "rb+") as f:
+    cache = common.ColorIndexCache()
+    with common.Stream(file, "rb+", buffered=True) as f:
         f.seek(ncgr.tileoffset)
         for i in range(height // ncgr.tilesize):
             for j in range(width // ncgr.tilesize):
-                writeNCGRTile(f, pixels, width, ncgr, i, j, palettes[0])
+                writeNCGRTile(f, pixels, width, ncgr, i, j, palettes[0], cache)
 
 
 def writeNSCR(file, ncgr, nscr, infile, palettes, width=-1, height=-1):
@@ -1010,7 +1195,8 @@ def writeNSCR(file, ncgr, nscr, infile, palettes, width=-1, height=-1):
     img = Image.open(infile)
     img = img.convert("RGBA")
     pixels = img.load()
-    with common.Stream(file, "rb+") as f:
+    cache = common.ColorIndexCache()
+    with common.Stream(file, "rb+", buffered=True) as f:
         donetiles = []
         x = 0
         for i in range(height // ncgr.tilesize):
@@ -1023,7 +1209,7 @@ def writeNSCR(file, ncgr, nscr, infile, palettes, width=-1, height=-1):
                 if map.tile not in donetiles:
                     donetiles.append(map.tile)
                     f.seek(ncgr.tileoffset + map.tile * (8 * ncgr.bpp))
-                    writeNCGRTile(f, pixels, width, ncgr, i, j, palettes[map.pal])
+                    writeNCGRTile(f, pixels, width, ncgr, i, j, palettes[map.pal], cache)
                 x += 1
 
 
@@ -1037,8 +1223,10 @@ def writeMultiMappedNSCR(file, mapfiles, ncgr, nscrs, infiles, palettes, width=-
     except ImportError:
         common.logError("PIL not found")
         return
-    with common.Stream(file, "rb+") as f:
+    cache = common.ColorIndexCache()
+    with common.Stream(file, "rb+", buffered=True) as f:
         tiles = []
+        tiledict = common.TileDict(ncgr.tilesize, ncgr.tilesize)
         if transptile:
             # Start with a completely transparent tile
             tile = []
@@ -1046,6 +1234,7 @@ def writeMultiMappedNSCR(file, mapfiles, ncgr, nscrs, infiles, palettes, width=-
                 for j2 in range(ncgr.tilesize):
                     tile.append(0)
             tiles.append(tile)
+            tiledict.add(tile, 0)
             f.seek(ncgr.tileoffset)
             for i2 in range(ncgr.tilesize):
                 for j2 in range(0, ncgr.tilesize, 2):
@@ -1060,31 +1249,38 @@ def writeMultiMappedNSCR(file, mapfiles, ncgr, nscrs, infiles, palettes, width=-
             img = Image.open(infiles[n])
             img = img.convert("RGBA")
             pixels = img.load()
+            alltilecolors = []
+            for i in range(imgheight // ncgr.tilesize):
+                for j in range(imgwidth // ncgr.tilesize):
+                    tilecolors = []
+                    for i2 in range(ncgr.tilesize):
+                        for j2 in range(ncgr.tilesize):
+                            tilecolors.append(pixels[j * ncgr.tilesize + j2, i * ncgr.tilesize + i2])
+                    alltilecolors.append(tilecolors)
+            if not useoldpal:
+                bestpals = common.findBestPalettes(palettes, alltilecolors)
             x = 0
-            with common.Stream(mapfiles[n], "rb+") as mapf:
+            with common.Stream(mapfiles[n], "rb+", buffered=True) as mapf:
                 mapf.seek(nscrs[n].mapoffset)
                 for i in range(imgheight // ncgr.tilesize):
                     for j in range(imgwidth // ncgr.tilesize):
-                        tilecolors = []
-                        for i2 in range(ncgr.tilesize):
-                            for j2 in range(ncgr.tilesize):
-                                tilecolors.append(pixels[j * ncgr.tilesize + j2, i * ncgr.tilesize + i2])
                         if useoldpal:
                             pal = nscrs[n].maps[x].pal
                         else:
-                            pal = common.findBestPalette(palettes, tilecolors)
+                            pal = bestpals[x]
                         tile = []
-                        for tilecolor in tilecolors:
-                            tile.append(common.getPaletteIndex(palettes[pal], tilecolor))
+                        for tilecolor in alltilecolors[x]:
+                            tile.append(common.getPaletteIndex(palettes[pal], tilecolor, cache=cache))
                         # Search for a repeated tile
                         map = Map()
                         map.pal = pal
-                        map.tile, map.xflip, map.yflip = searchTile(tile, tiles, ncgr.tilesize)
+                        map.tile, map.xflip, map.yflip = tiledict.find(tile)
                         if map.tile == -1:
                             tiles.append(tile)
                             map.tile = len(tiles) - 1
+                            tiledict.add(tile, map.tile)
                             f.seek(ncgr.tileoffset + map.tile * (8 * ncgr.bpp))
-                            writeNCGRTile(f, pixels, imgwidth, ncgr, i, j, palettes[map.pal])
+                            writeNCGRTile(f, pixels, imgwidth, ncgr, i, j, palettes[map.pal], cache)
                         mapdata = (map.pal << 12) | (map.yflip << 11) | (map.xflip << 10) | map.tile
                         mapf.writeUShort(mapdata)
                         x += 1
@@ -1094,19 +1290,11 @@ def writeMultiMappedNSCR(file, mapfiles, ncgr, nscrs, infiles, palettes, width=-
 
 
 def searchTile(tile, tiles, tilesize=8):
-    tilex = common.flipTile(tile, True, False, tilesize, tilesize)
-    tiley = common.flipTile(tile, False, True, tilesize, tilesize)
-    tilexy = common.flipTile(tile, True, True, tilesize, tilesize)
+    # Use a common.TileDict instead when searching many tiles in the same list
+    tiledict = common.TileDict(tilesize, tilesize)
     for i in range(len(tiles)):
-        if tiles[i] == tile:
-            return i, False, False
-        if tiles[i] == tilex:
-            return i, True, False
-        if tiles[i] == tiley:
-            return i, False, True
-        if tiles[i] == tilexy:
-            return i, True, True
-    return -1, False, False
+        tiledict.add(list(tiles[i]), i)
+    return tiledict.find(tile)
 
 
 def writeNCER(file, ncerfile, ncgr, ncer, infile, palettes, width=0, height=0, appendTiles=False, checkRepeat=True, writelen=True, fixtransp=False, checkalpha=False, zerotransp=True):
@@ -1117,41 +1305,18 @@ def writeNCER(file, ncerfile, ncgr, ncer, infile, palettes, width=0, height=0, a
         return
     psd = infile.endswith(".psd")
     if psd:
-        magickcmd = ""
-        if os.path.isfile("magick"):
-            magickcmd = "./magick"
-        elif shutil.which("magick"):
-            magickcmd = shutil.which("magick")
-        if magickcmd == "":
-            common.logError("ImageMagick not found")
-            return
         basename = os.path.basename(infile).replace(".psd", "")
-        # Get the layer names by using identify
-        identifycmd = magickcmd + " identify -verbose " + infile
-        if os.name != "nt":
-            psdinfo = subprocess.check_output(shlex.split(identifycmd))
-        else:
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            psdinfo = subprocess.check_output(identifycmd, startupinfo=startupinfo)
-        layernames = []
-        while psdinfo:
-            parts = psdinfo.partition(b"label: ")
-            lastpart = parts[2]
-            if lastpart:
-                index = lastpart.find(b"\n")
-                if index != -1:
-                    layernames.append(lastpart[:index].decode("ascii").strip())
-            psdinfo = lastpart
-        # Export them as PNG
-        for i in range(len(layernames)):
-            common.execute(magickcmd + " convert \"" + infile + "[0]\" \"" + infile + "[" + str(i + 1) + "]\" ( -clone 0 -alpha transparent ) -swap 0 +delete -coalesce -compose src-over -composite \"layer_" + layernames[i] + ".png\"", False)
+        psdlayers = common.readPSD(infile)
+        if psdlayers is None:
+            return
+        psdlayers = {name.strip(): image for name, image in psdlayers}
     else:
         img = Image.open(infile)
         img = img.convert("RGBA")
         pixels = img.load()
     nexttile = len(ncgr.tiles)
-    with common.Stream(file, "rb+") as f:
+    cache = common.ColorIndexCache()
+    with common.Stream(file, "rb+", buffered=True) as f:
         with common.Stream(ncerfile, "rb+") as fn:
             currheight = 0
             donetiles = []
@@ -1164,16 +1329,11 @@ def writeNCER(file, ncerfile, ncgr, ncer, infile, palettes, width=0, height=0, a
                     # Extract layers from the psd file, searching them by name
                     layers = []
                     for i in range(bank.layernum):
-                        layername = "layer_" + basename + "_" + str(nceri) + "_" + str(i) + ".png"
-                        if not os.path.isfile(layername):
+                        layername = basename + "_" + str(nceri) + "_" + str(i)
+                        if layername not in psdlayers:
                             common.logError("Layer", layername, "not found")
-                            for layername in layernames:
-                                os.remove("layer_" + layername + ".png")
                             return
-                        # Copy the layer in a normal PIL image for cell access
-                        layerimg = Image.open(layername)
-                        layerimg = layerimg.convert("RGBA")
-                        layers.append(layerimg)
+                        layers.append(psdlayers[layername])
                 for cell in bank.cells:
                     # Skip flipped cells since there's always(?) going to be an unflipped one next
                     if cell.xflip or cell.yflip:
@@ -1203,8 +1363,8 @@ def writeNCER(file, ncerfile, ncgr, ncer, infile, palettes, width=0, height=0, a
                                         else:
                                             pixelx = cell.x + j * ncgr.tilesize + j2
                                             pixely = currheight + cell.y + i * ncgr.tilesize + i2
-                                        index1 = common.getPaletteIndex(palette, pixels[pixelx, pixely], fixtransp, pali, 16 if ncgr.bpp == 4 else -1, checkalpha, zerotransp)
-                                        index2 = common.getPaletteIndex(palette, pixels[pixelx + 1, pixely], fixtransp, pali, 16 if ncgr.bpp == 4 else -1, checkalpha, zerotransp)
+                                        index1 = common.getPaletteIndex(palette, pixels[pixelx, pixely], fixtransp, pali, 16 if ncgr.bpp == 4 else -1, checkalpha, zerotransp, cache=cache)
+                                        index2 = common.getPaletteIndex(palette, pixels[pixelx + 1, pixely], fixtransp, pali, 16 if ncgr.bpp == 4 else -1, checkalpha, zerotransp, cache=cache)
                                         tiledata.append(index1)
                                         tiledata.append(index2)
                         sametile = tiledata == cellboxes[tile]
@@ -1242,8 +1402,8 @@ def writeNCER(file, ncerfile, ncgr, ncer, infile, palettes, width=0, height=0, a
                                             else:
                                                 pixelx = cell.x + j * ncgr.tilesize + j2
                                                 pixely = currheight + cell.y + i * ncgr.tilesize + i2
-                                            index1 = common.getPaletteIndex(palette, pixels[pixelx, pixely], fixtransp, pali, 16 if ncgr.bpp == 4 else -1, checkalpha, zerotransp)
-                                            index2 = common.getPaletteIndex(palette, pixels[pixelx + 1, pixely], fixtransp, pali, 16 if ncgr.bpp == 4 else -1, checkalpha, zerotransp)
+                                            index1 = common.getPaletteIndex(palette, pixels[pixelx, pixely], fixtransp, pali, 16 if ncgr.bpp == 4 else -1, checkalpha, zerotransp, cache=cache)
+                                            index2 = common.getPaletteIndex(palette, pixels[pixelx + 1, pixely], fixtransp, pali, 16 if ncgr.bpp == 4 else -1, checkalpha, zerotransp, cache=cache)
                                             cellboxes[currtile].append(index1)
                                             cellboxes[currtile].append(index2)
                                             writeNCGRData(f, ncgr.bpp, index1, index2)
@@ -1257,9 +1417,6 @@ def writeNCER(file, ncerfile, ncgr, ncer, infile, palettes, width=0, height=0, a
             f.writeUInt(tottiles)
             f.seek(4, 1)
             f.writeUInt(tottiles * (8 * ncgr.bpp))
-    if psd:
-        for layername in layernames:
-            os.remove("layer_" + layername + ".png")
 
 
 # 3D Models
@@ -1547,35 +1704,36 @@ def writeNSBMD(file, nsbmd, texi, infile, fixtransp=False, checkalpha=False, zer
     img = img.convert("RGBA")
     pixels = img.load()
     tex = nsbmd.textures[texi]
-    with common.Stream(file, "r+b") as f:
+    with common.Stream(file, "r+b", buffered=True) as f:
         # Read palette
         if tex.format != 7:
             palette = nsbmd.palettes[texi]
             paldata = palette.data
+            indexes = common.getPaletteIndexes(paldata, list(img.getdata()), fixtransp=fixtransp, checkalpha=checkalpha, zerotransp=zerotransp, backwards=backwards)
         # Write new texture data
         f.seek(tex.offset)
         # A3I5 Translucent Texture (3bit Alpha, 5bit Color Index)
         if tex.format == 1:
             for i in range(tex.height):
                 for j in range(tex.width):
-                    index = common.getPaletteIndex(paldata, pixels[j, i], fixtransp=fixtransp, checkalpha=checkalpha, zerotransp=zerotransp, backwards=backwards)
+                    index = indexes[i * img.width + j]
                     alpha = (pixels[j, i][3] * 8) // 256
                     f.writeByte(index | (alpha << 5))
         # 4-color Palette
         elif tex.format == 2:
             for i in range(tex.height):
                 for j in range(0, tex.width, 4):
-                    index1 = common.getPaletteIndex(paldata, pixels[j, i], fixtransp=fixtransp, checkalpha=checkalpha, zerotransp=zerotransp, backwards=backwards)
-                    index2 = common.getPaletteIndex(paldata, pixels[j + 1, i], fixtransp=fixtransp, checkalpha=checkalpha, zerotransp=zerotransp, backwards=backwards)
-                    index3 = common.getPaletteIndex(paldata, pixels[j + 2, i], fixtransp=fixtransp, checkalpha=checkalpha, zerotransp=zerotransp, backwards=backwards)
-                    index4 = common.getPaletteIndex(paldata, pixels[j + 3, i], fixtransp=fixtransp, checkalpha=checkalpha, zerotransp=zerotransp, backwards=backwards)
+                    index1 = indexes[i * img.width + j]
+                    index2 = indexes[i * img.width + j + 1]
+                    index3 = indexes[i * img.width + j + 2]
+                    index4 = indexes[i * img.width + j + 3]
                     f.writeByte((index4 << 6) | (index3 << 4) | (index2 << 2) | index1)
         # 16/256-color Palette
         elif tex.format == 3 or tex.format == 4:
             for i in range(tex.height):
                 for j in range(0, tex.width, 2):
-                    index1 = common.getPaletteIndex(paldata, pixels[j, i], fixtransp=fixtransp, checkalpha=checkalpha, zerotransp=zerotransp, backwards=backwards)
-                    index2 = common.getPaletteIndex(paldata, pixels[j + 1, i], fixtransp=fixtransp, checkalpha=checkalpha, zerotransp=zerotransp, backwards=backwards)
+                    index1 = indexes[i * img.width + j]
+                    index2 = indexes[i * img.width + j + 1]
                     writeNCGRData(f, 4 if tex.format == 3 else 8, index1, index2)
         # 4x4-Texel Compressed Texture
         elif tex.format == 5:
@@ -1584,7 +1742,7 @@ def writeNSBMD(file, nsbmd, texi, infile, fixtransp=False, checkalpha=False, zer
         elif tex.format == 6:
             for i in range(tex.height):
                 for j in range(tex.width):
-                    index = common.getPaletteIndex(paldata, pixels[j, i], fixtransp=fixtransp, checkalpha=checkalpha, zerotransp=zerotransp, backwards=backwards)
+                    index = indexes[i * img.width + j]
                     alpha = (pixels[j, i][3] * 32) // 256
                     f.writeByte(index | (alpha << 3))
         # Direct Color Texture
@@ -1677,9 +1835,7 @@ def readNBFP(ntfpfile, bpp=8):
             pallen = 32
         colornum = pallen // 2
         for i in range(size // pallen):
-            palette = []
-            for j in range(colornum):
-                palette.append(common.readPalette(f.readUShort()))
+            palette = common.decodeColors(f.readUShortArray(colornum), "BGR555")
             palettes.append(palette)
         indexedpalettes = {i: palettes[i] for i in range(0, len(palettes))}
     common.logDebug("Loaded", len(indexedpalettes), "palettes")
@@ -1698,16 +1854,7 @@ def readNBFC(ntftfile, palette, lineal, bpp=0):
     with common.Stream(ntftfile, "rb") as f:
         tiledata = f.read()
     tilelen = len(tiledata)
-    for i in range(tilelen // (8 * nbfc.bpp)):
-        singletile = []
-        for j in range(nbfc.tilesize * nbfc.tilesize):
-            x = i * (nbfc.tilesize * nbfc.tilesize) + j
-            if nbfc.bpp == 4:
-                index = (tiledata[x // 2] >> ((x % 2) << 2)) & 0x0f
-            else:
-                index = tiledata[x]
-            singletile.append(index)
-        nbfc.tiles.append(singletile)
+    nbfc.tiles = unpackTiles(tiledata, nbfc.bpp, tilelen // (8 * nbfc.bpp), nbfc.tilesize)
     numpix = tilelen * 8 / nbfc.bpp
     root = int(math.sqrt(numpix))
     if math.pow(root, 2) == numpix:
@@ -1724,9 +1871,8 @@ def readNBFC(ntftfile, palette, lineal, bpp=0):
 def readNBFS(nscrfile):
     nbfs = NSCR()
     with common.Stream(nscrfile, "rb") as f:
-        mapdata = f.read()
-    for i in range(0, len(mapdata), 2):
-        data = struct.unpack("<h", mapdata[i:i+2])[0]
+        mapdata = f.readUShortArray(os.path.getsize(nscrfile) // 2)
+    for data in mapdata:
         map = readMapData(data)
         nbfs.maps.append(map)
     maplen = len(nbfs.maps)
@@ -67,7 +67,7 @@ def repackUMD(umdfile, umdpatch, workfolder, patchfile="", sectorpadding=1):
     common.logMessage("Repacking UMD", umdpatch, "...")
     allfiles = common.getFiles(workfolder)
     isofiles = []
-    with common.Stream(umdfile, "rb") as fin:
+    with common.Stream(umdfile, "mmap") as fin:
         rootlba = fin.readUIntAt(0x809e)
         rootlength = fin.readUIntAt(0x80a6)
         common.logDebug("rootlba", common.toHex(rootlba), "rootlength", common.toHex(rootlength))
@@ -100,7 +100,7 @@ def repackUMD(umdfile, umdpatch, workfolder, patchfile="", sectorpadding=1):
                 if f.tell() // 0x800 < isofile.filelba:
                     f.seek(isofile.filelba * 0x800)
                 offset = f.tell()
-                with common.Stream(workfolder + isofile.realname, "rb") as subf:
+                with common.Stream(workfolder + isofile.realname, "mmap") as subf:
                     f.write(subf.read())
                 size = f.tell() - offset
                 # Pad to sector
@@ -197,18 +197,10 @@ def readELF(infile):
         common.logDebug("sectionsoff:", sectionsoff, "sectionsize:", sectionsize, "sectionnum", sectionnum, "shstrndx", shstrndx)
         # Read section headers
         f.seek(sectionsoff)
-        for i in range(sectionnum):
+        for sectiondata in f.readStructArray("10I", sectionnum):
             section = ELFSection()
-            section.nameoff = f.readUInt()
-            section.type = f.readUInt()
-            section.flags = f.readUInt()
-            section.addr = f.readUInt()
-            section.offset = f.readUInt()
-            section.size = f.readUInt()
-            section.link = f.readUInt()
-            section.info = f.readUInt()
-            section.addralign = f.readUInt()
-            section.entsize = f.readUInt()
+            (section.nameoff, section.type, section.flags, section.addr, section.offset,
+             section.size, section.link, section.info, section.addralign, section.entsize) = sectiondata
             elf.sections.append(section)
         # Read section names
         for section in elf.sections:
@@ -457,16 +449,20 @@ def readGIMBlock(f, gim, image):
             common.logError("Unsupported image format:", image.format)
             return image.imgoff + nextblock, image
         f.seek(image.imgoff + 32 + image.imgframeoff)
-        for i in range(image.blockedheight if image.tiled == 0x01 else image.height):
-            for j in range(image.blockedwidth if image.tiled == 0x01 else image.width):
-                index = 0
-                if image.format == 0x04:
-                    index = f.readHalf()
-                elif image.format == 0x05:
-                    index = f.readByte()
-                else:
-                    index = readColor(f, image.format)
-                image.colors.append(index)
+        if image.format in gimcolorformats:
+            pixelnum = (image.blockedheight * image.blockedwidth) if image.tiled == 0x01 else (image.height * image.width)
+            image.colors = common.decodeColors(f.readUShortArray(pixelnum), gimcolorformats[image.format])
+        else:
+            for i in range(image.blockedheight if image.tiled == 0x01 else image.height):
+                for j in range(image.blockedwidth if image.tiled == 0x01 else image.width):
+                    index = 0
+                    if image.format == 0x04:
+                        index = f.readHalf()
+                    elif image.format == 0x05:
+                        index = f.readByte()
+                    else:
+                        index = readColor(f, image.format)
+                    image.colors.append(index)
         common.logDebug("imgoff", image.imgoff, "imgsize", image.imgsize, "imgframeoff", image.imgframeoff, "format", image.format, "bpp", image.bpp)
         common.logDebug("tiled", image.tiled, "width", image.width, "height", image.height)
         common.logDebug("blockedwidth", image.blockedwidth, "blockedheight", image.blockedheight, "tilewidth", image.tilewidth, "tileheight", image.tileheight)
@@ -482,6 +478,8 @@ def readGIMBlock(f, gim, image):
         f.seek(2, 1)
         image.palformat = f.readUShort()
         f.seek(image.paloff + 32 + image.palframeoff)
+        if image.palformat in gimcolorformats:
+            image.palette = common.decodeColors(f.read(max(0, image.paloff + nextblock - f.tell())), gimcolorformats[image.palformat])
         while f.tell() < image.paloff + nextblock:
             image.palette.append(readColor(f, image.palformat))
         common.logDebug("paloff", image.paloff, "palsize", image.palsize, "palframeoff", image.palframeoff)
@@ -503,14 +501,15 @@ def writeGIM(file, gim, infile, backwardspal=False):
     img = img.convert("RGBA")
     pixels = img.load()
     currheight = 0
-    with common.Stream(file, "rb+") as f:
+    cache = common.ColorIndexCache()
+    with common.Stream(file, "rb+", buffered=True) as f:
         if isinstance(gim, GIM):
             for image in gim.images:
                 f.seek(image.imgoff + 32 + image.imgframeoff)
                 if image.tiled == 0x00:
                     for i in range(image.height):
                         for j in range(image.width):
-                            writeGIMPixel(f, image, pixels[j, currheight + i], backwardspal)
+                            writeGIMPixel(f, image, pixels[j, currheight + i], backwardspal, cache)
                 else:
                     for blocky in range(image.blockedheight // image.tileheight):
                         for blockx in range(image.blockedwidth // image.tilewidth):
@@ -519,9 +518,9 @@ def writeGIM(file, gim, infile, backwardspal=False):
                                     pixelx = blockx * image.tilewidth + x
                                     pixely = currheight + blocky * image.tileheight + y
                                     if pixelx >= image.width or pixely >= currheight + image.height:
-                                        writeGIMPixel(f, image, None, backwardspal)
+                                        writeGIMPixel(f, image, None, backwardspal, cache)
                                     else:
-                                        writeGIMPixel(f, image, pixels[pixelx, pixely], backwardspal)
+                                        writeGIMPixel(f, image, pixels[pixelx, pixely], backwardspal, cache)
                 if len(image.palette) > 0:
                     palsize = 5 * (len(image.palette) // 8)
                     currheight += max(image.height, palsize)
@@ -534,9 +533,9 @@ def writeGIM(file, gim, infile, backwardspal=False):
                    writeColor(f, 0x03, pixels[j, gim.height - 1 - i])
 
 
-def writeGIMPixel(f, image, color, backwards=False):
+def writeGIMPixel(f, image, color, backwards=False, cache=None):
     if image.format == 0x04 or image.format == 0x05:
-        index = common.getPaletteIndex(image.palette, color, False, 0, -1, True, False, backwards) if color is not None else 0
+        index = common.getPaletteIndex(image.palette, color, False, 0, -1, True, False, backwards, cache=cache) if color is not None else 0
         if image.format == 0x04:
             f.writeHalf(index)
         elif image.format == 0x05:
@@ -545,26 +544,17 @@ def writeGIMPixel(f, image, color, backwards=False):
         writeColor(f, image.format, color if color is not None else (0, 0, 0, 0))
 
 
+gimcolorformats = {
+    0x00: "RGBA5650",
+    0x01: "RGBA5551",
+    0x02: "RGBA4444",
+}
+
+
 def readColor(f, format):
     r, g, b, a = (0, 0, 0, 255)
-    if format == 0x00:  # RGBA5650
-        color = f.readUShort()
-        r = ((color & 0x001F)) << 3
-        g = ((color & 0x07E0) >> 5) << 2
-        b = ((color & 0xF800) >> 11) << 3
-    elif format == 0x01:  # RGBA5551
-        color = f.readUShort()
-        r = ((color & 0x001F)) << 3
-        g = ((color & 0x03E0) >> 5) << 3
-        b = ((color & 0x7C00) >> 10) << 3
-        a = ((color & 0x8000) >> 15) << 7
-        a += 127
-    elif format == 0x02:  # RGBA4444
-        color = f.readUShort()
-        r = ((color & 0x000F)) * 0x11
-        g = ((color & 0x00F0) >> 4) * 0x11
-        b = ((color & 0x0F00) >> 8) * 0x11
-        a = ((color & 0xF000) >> 12) * 0x11
+    if format in gimcolorformats:
+        return common.getColorTable(gimcolorformats[format])[f.readUShort()]
     elif format == 0x03:  # RGBA8888
         color = f.readUInt()
         r = (color & 0x000000FF)
@@ -51,7 +51,7 @@ def extractEXE(binrange, readfunc=common.detectEncodedString, encoding="shift_ji
     common.logMessage("Done! Extracted", len(strings), "lines")
 
 
-def repackEXE(binrange, freeranges=None, manualptrs=None, readfunc=common.detectEncodedString, writefunc=common.writeEncodedString, encoding="shift_jis", comments="#", exein="", exeout="", ptrfile="data/manualptrs.asm", exefile="data/exe_input.txt"):
+def repackEXE(binrange, freeranges=None, manualptrs=None, readfunc=common.detectEncodedString, writefunc=common.writeEncodedString, encoding="shift_jis", comments="#", exein="", exeout="", ptrfile="data/manualptrs.asm", exefile="data/exe_input.txt", pointerindex=None):
     if not os.path.isfile(exefile):
         common.logError("Input file", exefile, "not found")
         return False
@@ -59,12 +59,11 @@ def repackEXE(binrange, freeranges=None, manualptrs=None, readfunc=common.detect
     common.copyFile(exein, exeout)
     common.logMessage("Repacking EXE from", exefile, "...")
     section = {}
-    with codecs.open(exefile, "r", "utf-8") as bin:
-        section = common.getSection(bin, "", comments)
-        chartot, transtot = common.getSectionPercentage(section)
+    section = common.getSectionFile(exefile, comments).getSection()
+    chartot, transtot = common.getSectionPercentage(section)
     if type(binrange) == tuple:
         binrange = [binrange]
-    notfound = common.repackBinaryStrings(section, exein, exeout, binrange, freeranges, readfunc, writefunc, encoding, 0x8000f800)
+    notfound = common.repackBinaryStrings(section, exein, exeout, binrange, freeranges, readfunc, writefunc, encoding, 0x8000f800, pointerindex=pointerindex)
     # Handle not found pointers by manually replacing the opcodes
     if len(notfound) > 0 and manualptrs is not None:
         with open(ptrfile, "w") as f:
@@ -176,23 +175,22 @@ def readTIM(f, forcesize=0):
 
 
 def readCLUTData(f, clutwidth):
-    clut = []
-    for j in range(clutwidth):
-        color = common.readRGB5A1(f.readUShort())
-        clut.append(color)
-    return clut
+    return common.decodeColors(f.readUShortArray(clutwidth), "RGB5A1")
 
 
 def readTIMData(f, tim, pixelnum):
+    if tim.bpp == 16:
+        data = f.read(pixelnum * 2)
+        tim.data.extend(common.decodeColors(data, "RGB5A1"))
+        if len(data) < pixelnum * 2:
+            common.logWarning("Malformed TIM")
+        return
     try:
         for i in range(pixelnum):
             if tim.bpp == 4:
                 tim.data.append(f.readHalf())
             elif tim.bpp == 8:
                 tim.data.append(f.readByte())
-            elif tim.bpp == 16:
-                color = common.readRGB5A1(f.readUShort())
-                tim.data.append(color)
             elif tim.bpp == 24:
                 tim.data.append((f.readByte(), f.readByte(), f.readByte(), 255))
     except struct.error:
@@ -277,19 +275,25 @@ def writeTIM(f, tim, infile, transp=False, forcepal=-1, palsize=0):
     if isinstance(infile, str):
         img = Image.open(infile)
         img = img.convert("RGBA")
-        pixels = img.load()
         maxwidth = img.width - palsize
         maxheight = img.height
+        indexes = common.getPaletteIndexes(tim.cluts[clut], list(img.getdata()), checkalpha=transp, zerotransp=False)
     else:
         pixels = infile
+        indexes = None
+    buffered = f.isBuffered()
+    f.setBuffered(True)
     f.seek(tim.dataoff)
     for i in range(tim.height):
         for j in range(tim.width):
             if j >= maxwidth or i >= maxheight:
                 index = 0
+            elif indexes is not None:
+                index = indexes[i * img.width + j]
             else:
                 index = common.getPaletteIndex(tim.cluts[clut], pixels[j, i], checkalpha=transp, zerotransp=False)
             if tim.bpp == 4:
                 f.writeHalf(index)
             else:
                 f.writeByte(index)
+    f.setBuffered(buffered)
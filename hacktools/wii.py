@@ -132,8 +132,7 @@ def readTPL(file):
                     common.logError("Unimplemented palette format:", image.palformat)
                     continue
                 f.seek(image.paldataoff)
-                for j in range(palcount):
-                    image.palette.append(common.readRGB5A3(f.readShort()))
+                image.palette = common.decodeColors(f.readUShortArray(palcount), "RGB5A3")
             f.seek(image.imgoff)
             image.height = f.readUShort()
             image.width = f.readUShort()
@@ -155,7 +154,7 @@ def writeTPL(file, tpl, infile):
     except ImportError:
         common.logError("PIL not found")
         return
-    with common.Stream(file, "r+b", False) as f:
+    with common.Stream(file, "r+b", False, buffered=True) as f:
         for i in range(tpl.imgnum):
             image = tpl.images[i]
             imgfile = infile
@@ -172,6 +171,8 @@ def writeTPL(file, tpl, infile):
                 f.writeUShort(image.height)
                 f.writeUShort(image.width)
             pixels = img.load()
+            if image.format != 0x02:
+                indexes = common.getPaletteIndexes(image.palette, list(img.getdata()), False, 0, -1, True, False)
             f.seek(image.dataoff)
             for y in range(0, image.blockheight, image.tileheight):
                 for x in range(0, image.blockwidth, image.tilewidth):
@@ -183,7 +184,7 @@ def writeTPL(file, tpl, infile):
                                 if image.format == 0x02:
                                     index = ((color[3] // 0x11) << 4) | (color[0] // 0x11)
                                 else:
-                                    index = common.getPaletteIndex(image.palette, color, False, 0, -1, True, False)
+                                    index = indexes[(y + y2) * img.width + x + x2]
                             if image.format == 0x08:
                                 f.writeHalf(index, False)
                             else:
@@ -254,8 +255,7 @@ def repackFontData(infile, outfile, datafile):
     common.logMessage("Repacking font data from", datafile, "...")
     common.copyFile(infile, outfile)
     glyphs = getFontGlyphs(infile)
-    with codecs.open(datafile, "r", "utf-8") as f:
-        section = common.getSection(f, "")
+    section = common.getSectionFile(datafile).getSection()
     if len(section) == 0:
         return
     with common.Stream(outfile, "rb+", False) as f:
@@ -100,12 +100,12 @@ def readTile(f, pixels, x, y, palette, hflip=False, vflip=False, bpp=2):
                 pixels[x + posx, y + posy] = palette[index]
 
 
-def writeTile(f, pixels, x, y, palette, bpp=2):
+def writeTile(f, pixels, x, y, palette, bpp=2, cache=None):
     for y2 in range(8):
         if bpp == 2:
             b1 = b2 = 0
             for x2 in range(8):
-                index = common.getPaletteIndex(palette, pixels[x + x2, y + y2], zerotransp=False)
+                index = common.getPaletteIndex(palette, pixels[x + x2, y + y2], zerotransp=False, cache=cache)
                 lo = index & 1
                 hi = (index >> 1) & 1
                 b2 |= (hi << (7 - x2))
@@ -115,7 +115,7 @@ def writeTile(f, pixels, x, y, palette, bpp=2):
         else:
             b1 = b2 = b3 = b4 = 0
             for x2 in range(8):
-                index = common.getPaletteIndex(palette, pixels[x + x2, y + y2], zerotransp=False)
+                index = common.getPaletteIndex(palette, pixels[x + x2, y + y2], zerotransp=False, cache=cache)
                 lo = index & 1
                 lo2 = (index >> 1) & 1
                 hi = (index >> 2) & 1
@@ -167,9 +167,13 @@ def repackImage(f, infile, width, height, palette=None, bpp=2):
     img = Image.open(infile)
     img = img.convert("RGBA")
     pixels = img.load()
+    buffered = f.isBuffered()
+    f.setBuffered(True)
+    cache = common.ColorIndexCache()
     for y in range(height // 8):
         for x in range(width // 8):
-            writeTile(f, pixels, x * 8, y * 8, palette, bpp=bpp)
+            writeTile(f, pixels, x * 8, y * 8, palette, bpp=bpp, cache=cache)
+    f.setBuffered(buffered)
 
 
 def extractTiledImage(f, outfile, width, height, palette=None, bpp=2):
@@ -208,12 +212,16 @@ def repackTiledImage(f, infile, width, height, palette=None, bpp=2):
     img = Image.open(infile)
     img = img.convert("RGBA")
     pixels = img.load()
+    buffered = f.isBuffered()
+    f.setBuffered(True)
+    cache = common.ColorIndexCache()
     for y in range(height // 16):
         for x in range(width // 16):
-            writeTile(f, pixels, x * 16, y * 16, palette, bpp=bpp)
-            writeTile(f, pixels, x * 16, y * 16 + 8, palette, bpp=bpp)
-            writeTile(f, pixels, x * 16 + 8, y * 16, palette, bpp=bpp)
-            writeTile(f, pixels, x * 16 + 8, y * 16 + 8, palette, bpp=bpp)
+            writeTile(f, pixels, x * 16, y * 16, palette, bpp=bpp, cache=cache)
+            writeTile(f, pixels, x * 16, y * 16 + 8, palette, bpp=bpp, cache=cache)
+            writeTile(f, pixels, x * 16 + 8, y * 16, palette, bpp=bpp, cache=cache)
+            writeTile(f, pixels, x * 16 + 8, y * 16 + 8, palette, bpp=bpp, cache=cache)
+    f.setBuffered(buffered)
 
 
 class TileMap:
@@ -257,14 +265,7 @@ def readPalette(f, bpp=2, num=16):
             c4 = f.readHalf() * 0x11
             palettes.append([(c1, c1, c1, 0xff), (c2, c2, c2, 0xff), (c3, c3, c3, 0xff), (c4, c4, c4, 0xff)])
         else:
-            palette = []
-            for j in range(16):
-                col = f.readUShort()
-                b = (col & 0xf) * 0x11
-                g = ((col >> 4) & 0xf) * 0x11
-                r = ((col >> 8) & 0xf) * 0x11
-                palette.append((r, g, b, 0xff))
-            palettes.append(palette)
+            palettes.append(common.decodeColors(f.readUShortArray(16), "RGB444"))
     return palettes
 
 
@@ -440,7 +441,8 @@ def repackMappedImage(f, infile, tilestart, mapstart, num=1, readpal=False, writ
         return
     common.logDebug("Repacking", infile)
     maps = readMappedImage(f, infile, mapstart, num)
-    tiles = {}
+    tiles = common.TileDict()
+    cache = common.ColorIndexCache()
     if readpal:
         f.seek(mapstart - 32)
         palettes = readPalette(f, maps[0].bpp)
@@ -469,56 +471,47 @@ def repackMappedImage(f, infile, tilestart, mapstart, num=1, readpal=False, writ
         img = Image.open(imgname)
         img = img.convert("RGB")
         pixels = img.load()
+        # Convert the PNG tiles to colors only once
+        alltilecolors = []
+        for y in range(mapdata.height):
+            for x in range(mapdata.width):
+                tilecolors = []
+                for y2 in range(8):
+                    for x2 in range(8):
+                        tilecolors.append(pixels[x * 8 + x2, y * 8 + y2])
+                alltilecolors.append(tilecolors)
+        if writepal:
+            bestpals = common.findBestPalettes(palettes, alltilecolors)
         # Loop the tiles in the PNG
         currmap = 0
         x = y = 0
         common.logDebug(mapdata.width, mapdata.height)
         while y < mapdata.height:
-            hflip = vflip = False
-            tilecolors = []
-            # Convert the PNG tile to indexes
-            for y2 in range(8):
-                for x2 in range(8):
-                    tilecolors.append(pixels[x * 8 + x2, y * 8 + y2])
+            tilecolors = alltilecolors[currmap]
             pal = 0
             if writepal:
-                pal = common.findBestPalette(palettes, tilecolors)
+                pal = bestpals[currmap]
             elif readpal:
                 pal = mapdata.map[currmap].pal
+            # Convert the PNG tile to indexes
             tile = []
             for tilecolor in tilecolors:
-                tile.append(common.getPaletteIndex(palettes[pal], tilecolor, zerotransp=False))
-            tile = tuple(tile)
-            # Check if we already have added this file
-            if tile in tiles:
-                maptile = tiles[tile]
-            else:
-                # Look for inverted tiles
-                hflipped = tuple(common.flipTile(tile, True, False))
-                vflipped = tuple(common.flipTile(tile, False, True))
-                hvflipped = tuple(common.flipTile(tile, True, True))
-                if hflipped in tiles:
-                    maptile = tiles[hflipped]
-                    hflip = True
-                elif vflipped in tiles:
-                    maptile = tiles[vflipped]
-                    vflip = True
-                elif hvflipped in tiles:
-                    maptile = tiles[hvflipped]
-                    hflip = vflip = True
+                tile.append(common.getPaletteIndex(palettes[pal], tilecolor, zerotransp=False, cache=cache))
+            # Check if we already have added this tile, also looking for inverted tiles
+            maptile, hflip, vflip = tiles.find(tile)
+            if maptile == -1:
+                # Check for space
+                if currtile > maxtile:
+                    common.logError("Not enough space for tile", (str(currtile) + "/" + str(maxtile)), "in", mapdata.name)
+                    currtile += 1
+                    maptile = mintile
                 else:
-                    # Check for space
-                    if currtile > maxtile:
-                        common.logError("Not enough space for tile", (str(currtile) + "/" + str(maxtile)), "in", mapdata.name)
-                        currtile += 1
-                        maptile = mintile
-                    else:
-                        # Add the new tile
-                        maptile = currtile
-                        currtile += 1
-                        tiles[tile] = maptile
-                        f.seek(tilestart + (maptile * 16))
-                        writeTile(f, pixels, x * 8, y * 8, palettes[pal], mapdata.bpp)
+                    # Add the new tile
+                    maptile = currtile
+                    currtile += 1
+                    tiles.add(tile, maptile)
+                    f.seek(tilestart + (maptile * 16))
+                    writeTile(f, pixels, x * 8, y * 8, palettes[pal], mapdata.bpp, cache)
             # Write the map data
             f.seek(mapdata.offset + 2 + currmap * 2)
             originalmap = mapdata.map[currmap]
@@ -26,6 +26,7 @@ extras_psp=["pycdlib", "pyeboot"]
 extras_ips=["ips_util"]
 extras_graphics=["Pillow"]
 extras_cli=["click", "tqdm", "customtkinter"]
+extras_numpy=["numpy"]
 
 setup(
     name="hacktools",
@@ -41,6 +42,7 @@ setup(
         Extension("hacktools.cmp_lzss", sources=["hacktools/c_ext/cmp_lzss.c"]),
         Extension("hacktools.cmp_cri",  sources=["hacktools/c_ext/cmp_cri.c"]),
         Extension("hacktools.cmp_misc", sources=["hacktools/c_ext/cmp_misc.c"]),
+        Extension("hacktools.str_scan", sources=["hacktools/c_ext/str_scan.c"]),
     ],
     classifiers=[
         "Programming Language :: Python :: 3.7",
@@ -60,7 +62,8 @@ setup(
         "ips": extras_ips,
         "graphics": extras_graphics,
         "cli": extras_cli,
-        "all": extras_nds + extras_armips + extras_xdelta + extras_iso + extras_psp + extras_ips + extras_graphics + extras_cli,
+        "numpy": extras_numpy,
+        "all": extras_nds + extras_armips + extras_xdelta + extras_iso + extras_psp + extras_ips + extras_graphics + extras_cli + extras_numpy,
     },
     python_requires=">=3.7",
 )
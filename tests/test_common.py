@@ -0,0 +1,438 @@
+import pytest
+import struct
+from hacktools import common
+
+
+@pytest.fixture
+def binfile(tmp_path):
+    path = tmp_path / "test.bin"
+    with open(path, "wb") as f:
+        f.write(bytes(range(256)) * 4)
+    return str(path)
+
+
+def test_stream_mmap(binfile):
+    with common.Stream(binfile, "mmap") as f:
+        data = f.read(4)
+        assert isinstance(data, memoryview)
+        assert data == b"\x00\x01\x02\x03"
+        assert f.readUInt() == 0x07060504
+        assert f.peek(2) == b"\x08\x09"
+        assert f.readAt(0x100, 2) == b"\x00\x01"
+        assert f.tell() == 8
+        f.seek(-2, 2)
+        assert f.read() == b"\xfe\xff"
+    # Slices stay valid after the stream is closed
+    assert bytes(data) == b"\x00\x01\x02\x03"
+
+
+def test_stream_mmap_write(binfile):
+    with common.Stream(binfile, "mmap+") as f:
+        f.seek(0x10)
+        f.writeUInt(0xdeadbeef)
+    with common.Stream(binfile, "rb") as f:
+        assert f.readUIntAt(0x10) == 0xdeadbeef
+
+
+@pytest.mark.parametrize("usenumpy", [False, True])
+def test_stream_arrays(monkeypatch, usenumpy):
+    if usenumpy and not common.hasNumpy:
+        pytest.skip("numpy not found")
+    monkeypatch.setattr(common, "hasNumpy", usenumpy)
+    for little in [True, False]:
+        with common.Stream(little=little) as f:
+            f.writeUShortArray([1, 0x1234, 0xffff])
+            f.writeUIntArray([0x12345678, 0])
+            f.writeStructArray("HI", [(1, 2), (3, 4)])
+            f.seek(0)
+            assert f.readUShort() == 1
+            f.seek(0)
+            assert f.readUShortArray(3) == [1, 0x1234, 0xffff]
+            assert f.readUIntArray(2) == [0x12345678, 0]
+            assert f.readStructArray("HI", 2) == [(1, 2), (3, 4)]
+
+
+def test_stream_buffered(binfile):
+    with common.Stream(binfile, "rb+", buffered=True) as f:
+        f.seek(0x10)
+        f.writeUInt(0xdeadbeef)
+        f.writeHalf(1)
+        f.writeHalf(2)
+        assert f.tell() == 0x15
+        assert f.readUIntAt(0x10) == 0xdeadbeef
+        f.seek(0x20)
+        f.writeZero(4)
+    with common.Stream(binfile, "rb") as f:
+        assert f.readUIntAt(0x10) == 0xdeadbeef
+        assert f.readByteAt(0x14) == 0x21
+        assert f.readUIntAt(0x20) == 0
+
+
+def test_stream_buffered_read_write(binfile):
+    with common.Stream(binfile, "rb+", buffered=True) as f:
+        f.seek(0)
+        assert f.readUInt() == 0x03020100
+        assert f.tell() == 4
+        f.writeByteAt(0x40, 0xaa)
+        assert f.tell() == 4
+        assert f.peek(2) == b"\x04\x05"
+        f.writeByte(0xbb)
+        assert f.tell() == 5
+        assert f.readByteAt(0x40) == 0xaa
+        assert f.tell() == 5
+        f.writeByte(0xcc)
+        assert f.readByte() == 0x06
+        assert f.tell() == 7
+    with common.Stream(binfile, "rb") as f:
+        assert f.read(8) == b"\x00\x01\x02\x03\xbb\xcc\x06\x07"
+        assert f.readByteAt(0x40) == 0xaa
+        assert f.readByteAt(1) == 0x01
+
+
+def test_iostats(binfile):
+    common.enableIOStats()
+    try:
+        with common.Stream(binfile, "rb") as f:
+            f.seek(4)
+            f.readUInt()
+            f.readUShortArray(2)
+        stat = common.iostats[__name__ + ".test_iostats"]
+        assert stat.reads == 2
+        assert stat.readbytes == 8
+        assert stat.seeks == 1
+    finally:
+        common.enableIOStats(False)
+
+
+@pytest.mark.parametrize("func", [common.detectEncodedString, common.detectASCIIString])
+def test_find_binary_strings(tmp_path, monkeypatch, func):
+    if not common.hasStrScan:
+        pytest.skip("str_scan not built")
+    data = b"\x01\x02%test\x00\xff" + "テスト".encode("shift_jis") + b"\x0aab\x00\x85\x40\x00ascii\x00" + b"\x00" * 8
+    binfile = str(tmp_path / "strings.bin")
+    with open(binfile, "wb") as f:
+        f.write(data)
+    results = []
+    for native in [True, False]:
+        monkeypatch.setattr(common, "hasStrScan", native)
+        results.append(common.extractBinaryStrings(binfile, [(0, len(data))], func))
+    assert results[0] == results[1]
+    assert len(results[0][0]) > 1
+
+
+def test_repack_binary_strings(tmp_path):
+    data = bytearray(0x100)
+    data[0:4] = (0x02000010).to_bytes(4, "little")
+    data[0x10:0x14] = b"%ab\x00"
+    data[0x20:0x24] = (0x02000010).to_bytes(4, "little")
+    infile = str(tmp_path / "in.bin")
+    outfile = str(tmp_path / "out.bin")
+    for file in [infile, outfile]:
+        with open(file, "wb") as f:
+            f.write(data)
+    section = {"%ab": ["%abcdefgh"]}
+    notfound = common.repackBinaryStrings(section, infile, outfile, [(0x10, 0x20)], [(0x40, 0x80)], pointerstart=0x02000000)
+    assert len(notfound) == 0
+    with common.Stream(outfile, "rb") as f:
+        assert f.readUIntAt(0) == 0x02000040
+        assert f.readUIntAt(0x20) == 0x02000040
+        f.seek(0x40)
+        assert common.detectEncodedString(f) == "%abcdefgh"
+
+
+def test_free_space():
+    freespace = common.FreeSpace([(0x100, 0x110), (0x200, 0x240), (0x300, 0x308, True)])
+    assert freespace.getFreeBytes() == 0x10 + 0x40 + 0x8
+    # Best fit
+    assert freespace.alloc(8) == (0x300, True)
+    assert freespace.alloc(8) == (0x100, False)
+    assert freespace.alloc(0x100) == (-1, False)
+    # Coalescing
+    freespace.free(0x110, 0x200)
+    assert freespace.starts == [0x108]
+    freespace.free(0x100, 0x108)
+    assert freespace.starts == [0x100]
+    assert freespace.getFragmentation() == 0
+    assert freespace.alloc(4, 0x10) == (0x100, False)
+    assert freespace.alloc(4, 0x10) == (0x110, False)
+    assert freespace.starts == [0x104, 0x114]
+
+
+def test_plan_binary_strings(tmp_path):
+    data = bytearray(0x100)
+    data[0:4] = (0x02000010).to_bytes(4, "little")
+    data[0x10:0x14] = b"%ab\x00"
+    infile = str(tmp_path / "in.bin")
+    with open(infile, "wb") as f:
+        f.write(data)
+    plan = common.planBinaryStrings({"%ab": ["%abcdefgh"]}, infile, [(0x10, 0x20)], [(0x40, 0x80)], pointerstart=0x02000000)
+    assert plan.pointers == [(0, 0x02000010, 0x02000040)]
+    assert plan.freespace.getFreeBytes() == 0x40 - 10 + 4
+    with open(infile, "rb") as f:
+        assert f.read() == data
+    assert plan.apply(bytearray(data))[0x40:0x4a] == b"%abcdefgh\x00"
+
+
+def test_plan_binary_strings_merge(tmp_path):
+    data = bytearray(0x100)
+    data[0:4] = (0x02000010).to_bytes(4, "little")
+    data[4:8] = (0x02000014).to_bytes(4, "little")
+    data[0x10:0x14] = b"%ab\x00"
+    data[0x14:0x18] = b"%cd\x00"
+    infile = str(tmp_path / "in.bin")
+    with open(infile, "wb") as f:
+        f.write(data)
+    section = {"%ab": ["%abcdefgh"], "%cd": ["%cdefghij"]}
+    plan = common.planBinaryStrings(section, infile, [(0x10, 0x20)], [(0x40, 0x80)], pointerstart=0x02000000)
+    assert plan.pointers == [(0, 0x02000010, 0x02000040), (4, 0x02000014, 0x0200004a)]
+    # The old strings and their terminators are merged in a single free range
+    assert [(start, plan.freespace.ranges[start][0]) for start in plan.freespace.starts] == [(0x10, 0x18), (0x54, 0x80)]
+
+
+def test_plan_binary_strings_section(tmp_path):
+    data = bytearray(0x20)
+    data[0x00:0x04] = b"%ab\x00"
+    data[0x04:0x08] = b"%ab\x00"
+    data[0x08:0x0c] = b"%ab\x00"
+    infile = str(tmp_path / "in.bin")
+    with open(infile, "wb") as f:
+        f.write(data)
+    section = {"%ab": ["%x", "%y"]}
+    plan = common.planBinaryStrings(section, infile, [(0, 0x10)])
+    assert section == {"%ab": ["%x", "%y"]}
+    assert plan.apply(bytearray(data))[0:0x0c] == b"%x\x00\x00%y\x00\x00%y\x00\x00"
+    plan = common.planBinaryStrings(section, infile, [(0, 0x10)])
+    assert plan.apply(bytearray(data))[0:0x0c] == b"%x\x00\x00%y\x00\x00%y\x00\x00"
+
+
+def test_section_file(tmp_path):
+    sectionfile = str(tmp_path / "sections.txt")
+    with open(sectionfile, "w", encoding="utf-8") as f:
+        f.write("!FILE:a\n#comment\nfoo=bar#note\nfoo=baz\n!FILE:b\nfoo=\nhello=world\n")
+    mergefile = str(tmp_path / "merge.txt")
+    with open(mergefile, "w", encoding="utf-8") as f:
+        f.write("!FILE:c\nfoo=\nnew=\nhello=\n")
+    sections = common.getSections(sectionfile)
+    with open(sectionfile, "r", encoding="utf-8") as f:
+        for name in ["a", "b"]:
+            assert sections[name] == common.getSection(f, name)
+            assert common.getSectionFile(sectionfile).getSection(name, True) == common.getSection(f, name, inorder=True)
+    outfile = str(tmp_path / "out.txt")
+    common.mergeSections(mergefile, sectionfile, outfile)
+    with open(outfile, "r", encoding="utf-8") as f:
+        assert f.read() == "!FILE:c\nfoo=bar\nnew=\nhello=world\n"
+
+
+def test_section_file_duplicates(tmp_path):
+    sectionfile = str(tmp_path / "sections.txt")
+    with open(sectionfile, "w", encoding="utf-8") as f:
+        f.write("foo=before\n!FILE:a\nhello=world\n!FILE:b\nbar=baz\n!FILE:a\nhello=again\nnew=line\n")
+    sections = common.getSections(sectionfile)
+    with open(sectionfile, "r", encoding="utf-8") as f:
+        assert sections == {"a": common.getSection(f, "a"), "b": common.getSection(f, "b")}
+    assert sections["a"] == {"hello": ["world"]}
+    mergefile = str(tmp_path / "merge.txt")
+    with open(mergefile, "w", encoding="utf-8") as f:
+        f.write("!FILE:c\nfoo=\nhello=\nnew=\n")
+    outfile = str(tmp_path / "out.txt")
+    common.mergeSections(mergefile, sectionfile, outfile)
+    with open(outfile, "r", encoding="utf-8") as f:
+        assert f.read() == "!FILE:c\nfoo=\nhello=world\nnew=\n"
+    # Changing the file is picked up by the cache
+    with open(sectionfile, "w", encoding="utf-8") as f:
+        f.write("!FILE:a\nhello=changed file\n")
+    assert common.getSections(sectionfile) == {"a": {"hello": ["changed file"]}}
+
+
+def test_translation_file(tmp_path):
+    mergefile = str(tmp_path / "merge.txt")
+    with open(mergefile, "w", encoding="utf-8") as f:
+        f.write("a=first\na=second\nb=\n")
+    translation = common.TranslationFile()
+    translation.addEntry("a", "file1", 0)
+    translation.addEntry("a", "file1", 4, "old")
+    translation.addEntry("b", "file1", 8)
+    translation.addEntry("a", "file2", 0)
+    translation.mergeSection(mergefile)
+    assert translation.getEntry("a", "file1", 0) == "first"
+    assert translation.getEntry("a", "file1", 4) == "second"
+    assert translation.getEntry("a", "file2", 0) == "second"
+    assert translation.getEntry("b", "file1", 8) == ""
+    assert translation.getEntry("a", "file1", 12) == "first"
+    xliff = str(tmp_path / "test.xliff")
+    translation.save(xliff)
+    translation = common.TranslationFile(xliff)
+    assert translation.getEntry("a", "file1", 4) == "second"
+    resaved = str(tmp_path / "resaved.xliff")
+    translation.save(resaved)
+    with open(xliff, "rb") as f1, open(resaved, "rb") as f2:
+        assert f1.read() == f2.read()
+
+
+def test_word_wrapper():
+    glyphs = {c: common.FontGlyph(0, 6, 6) for c in "abcdefghijklmnopqrstuvwxyz "}
+    wrapper = common.WordWrapper(glyphs, 60, codefunc=lambda s, i: 3 if s[i:i + 3] == "<c>" else 0)
+    assert wrapper.wrapMany(["aaaa bbbb cccc", "<c><c>aaaa bbbb", "aa>>bb"]) == ["aaaa bbbb|cccc", "<c><c>aaaa bbbb", "aa>>bb"]
+    assert wrapper.getWidth("<c>ab") == 12
+    assert wrapper.center("<<ab|cd") == "    ab|cd"
+    assert common.wordwrap("aaaa bbbb cccc", glyphs, 60) == "aaaa bbbb|cccc"
+    assert common.wordwrap(" aa  ", glyphs, 60, strip=False) == "aa "
+    assert common.wordwrap(" aa  >> bb ", glyphs, 60, strip=False) == "aa>>bb"
+    glyphs["a"] = common.FontGlyph(0, 12, 12)
+    assert common.wordwrap("aaaa bbbb cccc", glyphs, 60) == "aaaa|bbbb cccc"
+
+
+def test_check_overflow():
+    glyphs = {c: common.FontGlyph(0, 6, 6) for c in "abcdefghijklmnopqrstuvwxyz "}
+    sections = {"a": {"x": ["aaaa bbbb cccc"], "y": [""]}, "b": {"z": ["aaaaaaaaaaaa|b|c"]}}
+    overflows = common.checkOverflow(sections, glyphs, {"": 60, "b": 48}, {"a": 1, "b": 2})
+    assert [(x.section, x.line) for x in overflows] == [("a", "cccc"), ("b", "aaaaaaaaaaaa"), ("b", "c")]
+    assert len(common.checkOverflow({"x": ["aaaa bbbb"]}, glyphs, 60, 1)) == 0
+    assert len(common.checkOverflow(sections, {"a": glyphs, "b": glyphs}, 100)) == 0
+    with pytest.raises(ValueError, match="section b"):
+        common.checkOverflow(sections, {"a": glyphs}, 100)
+
+
+def test_table_codec(tmp_path):
+    tablefile = str(tmp_path / "table.tbl")
+    with open(tablefile, "w", encoding="utf-8") as f:
+        f.write("41=A\n8140= \n8141=あ\n814142=<long>\nzz=invalid\n")
+    codec = common.loadTableCodec(tablefile, "testtable")
+    assert codec.decode(b"A\x81\x40\x81\x41\x42A")[0] == "A <long>A"
+    assert codec.encode("A <long>あ")[0] == b"A\x81\x40\x81\x41\x42\x81\x41"
+    assert b"A\x81\x41\xff".decode("testtable", "replace") == "Aあ�"
+    assert "Aあ".encode("testtable") == b"A\x81\x41"
+    with pytest.raises(UnicodeEncodeError):
+        "B".encode("testtable")
+    with pytest.raises(ValueError):
+        common.loadTableCodec(tablefile, "TestTable")
+    assert "A".encode("testtable") == b"A"
+
+
+def test_table_codec_empty_value(tmp_path):
+    tablefile = str(tmp_path / "table.tbl")
+    with open(tablefile, "w", encoding="utf-8") as f:
+        f.write("00=\n3F=?\n41=A\n")
+    codec = common.TableCodec(tablefile, "emptytable")
+    assert codec.decode(b"A\x00A")[0] == "AA"
+    assert codec.encode("AA")[0] == b"AA"
+    with pytest.raises(UnicodeEncodeError):
+        codec.encode("AB")
+    assert codec.encode("AB", "replace")[0] == b"A?"
+
+
+def test_encode_string():
+    assert common.encodeString("aテ|UNK(8140)b") == (7, b"a\x83e\n\x81\x40b")
+    assert common.encodeString("aテ|UNK(8140)b", 4) == (-1, b"a\x83e\n")
+    with common.Stream() as f:
+        assert common.writeEncodedString(f, "ab～", 4) == 4
+        f.seek(0)
+        assert f.read() == b"ab\x81\x60\x00"
+
+
+@pytest.mark.parametrize("usenumpy", [False, True])
+def test_pointer_shifter(monkeypatch, usenumpy):
+    if usenumpy and not common.hasNumpy:
+        pytest.skip("numpy not found")
+    monkeypatch.setattr(common, "hasNumpy", usenumpy)
+    pointerdiff = {0x100: 4, 0x50: 2, 0x200: -1}
+    shifter = common.PointerShifter(pointerdiff)
+    pointers = [0, 0x50, 0x51, 0x100, 0x150, 0x201]
+    assert shifter.shiftMany(pointers) == [common.shiftPointer(x, pointerdiff) for x in pointers]
+    assert shifter.shift(0x201) == 0x201 + 5
+
+
+@pytest.mark.parametrize("usenumpy", [False, True])
+def test_palette_indexes(monkeypatch, usenumpy):
+    if usenumpy and not common.hasNumpy:
+        pytest.skip("numpy not found")
+    monkeypatch.setattr(common, "hasNumpy", usenumpy)
+    palette = [(0, 0, 0, 0), (255, 0, 0, 255), (0, 255, 0, 255), (255, 0, 0, 255), (10, 10, 10, 0)]
+    colors = [(0, 0, 0, 0), (255, 0, 0, 255), (250, 5, 0, 255), (1, 1, 1, 0), (0, 0, 0, 255), (0, 128, 0, 255)]
+    for fixtransp in [False, True]:
+        for checkalpha in [False, True]:
+            for backwards in [False, True]:
+                expected = [common.getPaletteIndex(palette, x, fixtransp, 0, -1, checkalpha, False, backwards) for x in colors]
+                assert common.getPaletteIndexes(palette, colors, fixtransp, 0, -1, checkalpha, False, backwards) == expected
+    assert common.getPaletteIndexes(palette, colors, starti=1, palsize=3) == [0, 0, 2, 0, 1, 1]
+
+
+def test_color_index_cache():
+    palette = [(0, 0, 0, 0), (255, 0, 0, 255), (0, 255, 0, 255)]
+    cache = common.ColorIndexCache(2)
+    colors = [(255, 0, 0, 255), (0, 250, 0, 255), (255, 0, 0, 255), (1, 2, 3, 255)]
+    assert [common.getPaletteIndex(palette, x, cache=cache) for x in colors] == [common.getPaletteIndex(palette, x) for x in colors]
+    assert list(cache.getColors(palette, (False, 0, -1, False, True, False)).keys()) == [(255, 0, 0, 255), (1, 2, 3, 255)]
+    assert common.getPaletteIndex(palette, (255, 0, 0, 0), checkalpha=True, zerotransp=False, cache=cache) == 0
+    assert len(cache.palettes) == 2
+
+
+@pytest.mark.parametrize("usenumpy", [False, True])
+def test_find_best_palettes(monkeypatch, usenumpy):
+    if usenumpy and not common.hasNumpy:
+        pytest.skip("numpy not found")
+    monkeypatch.setattr(common, "hasNumpy", usenumpy)
+    palettes = [[(0, 0, 0, 255), (255, 0, 0, 255)], [(0, 0, 0, 255), (0, 255, 0, 255)], [(0, 0, 0, 255), (0, 255, 0, 255)]]
+    tiles = [[(0, 0, 0, 255), (250, 0, 0, 255)], [(0, 240, 0, 255), (0, 0, 0, 0)], [(0, 0, 0, 255), (0, 0, 0, 255)]]
+    assert common.findBestPalettes(palettes, tiles) == [common.findBestPalette(palettes, x) for x in tiles] == [0, 1, 0]
+
+
+def test_decode_colors():
+    data = bytes([0x1f, 0x80, 0x00, 0x7c])
+    assert common.decodeColors(data, "RGB5A1") == [common.readRGB5A1(0x801f), common.readRGB5A1(0x7c00)]
+    assert common.decodeColors(data, "RGB5A3", False) == [common.readRGB5A3(0x1f80), common.readRGB5A3(0x007c)]
+    assert common.decodeColors([0x7fff, 0x1234], "BGR555") == [common.readPalette(0x7fff), common.readPalette(0x1234)]
+
+
+def test_tile_dict():
+    tile = [0, 1, 2, 3]
+    tiles = common.TileDict(2, 2)
+    tiles.add(tile, 5)
+    assert tiles.find(tile) == (5, False, False)
+    assert tiles.find([1, 0, 3, 2]) == (5, True, False)
+    assert tiles.find([2, 3, 0, 1]) == (5, False, True)
+    assert tiles.find([3, 2, 1, 0]) == (5, True, True)
+    assert tiles.find([0, 0, 0, 0]) == (-1, False, False)
+
+
+def test_psd(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    layer1 = Image.new("RGBA", (16, 8), (0, 0, 0, 0))
+    layer1.putpixel((3, 2), (255, 0, 0, 255))
+    layer1.putpixel((10, 5), (0, 0, 255, 128))
+    layer2 = Image.new("RGBA", (16, 8), (0, 0, 0, 0))
+    psdfile = str(tmp_path / "test.psd")
+    common.writePSD(psdfile, [("layer1", layer1), ("layer2", layer2)], layer1)
+    layers = common.readPSD(psdfile)
+    assert [x[0] for x in layers] == ["layer1", "layer2"]
+    assert layers[0][1].tobytes() == layer1.tobytes()
+    assert layers[1][1].tobytes() == layer2.tobytes()
+    assert common.decompressPackBits(bytes.fromhex("FEAA0280002AFD")) == bytes.fromhex("AAAAAA80002A")
+
+
+def test_psd_packbits(tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    # A single 4x2 layer at (1, 1), with each channel row compressed as a run or literal bytes
+    rows = {0: [b"\xfd\x10", b"\x03\x01\x02\x03\x04"], 1: [b"\xfd\x20", b"\xfd\x30"], 2: [b"\x03\x05\x06\x07\x08", b"\xfd\x40"], -1: [b"\xfd\xff", b"\x01\x00\x80\xff\xff"]}
+    channels = {}
+    for channelid, packed in rows.items():
+        channels[channelid] = struct.pack(">H", 1) + b"".join(struct.pack(">H", len(x)) for x in packed) + b"".join(packed)
+    record = struct.pack(">iiiiH", 1, 1, 3, 5, len(channels))
+    for channelid, data in channels.items():
+        record += struct.pack(">hI", channelid, len(data))
+    record += b"8BIMnorm" + bytes([255, 0, 0, 0])
+    extra = struct.pack(">II", 0, 0) + b"\x05layer\x00\x00"
+    record += struct.pack(">I", len(extra)) + extra
+    layerinfo = struct.pack(">h", 1) + record + b"".join(channels.values())
+    data = b"8BPS" + struct.pack(">H6xHIIHH", 1, 4, 4, 8, 8, 3) + struct.pack(">II", 0, 0)
+    data += struct.pack(">II", len(layerinfo) + 4, len(layerinfo)) + layerinfo
+    psdfile = str(tmp_path / "test.psd")
+    with open(psdfile, "wb") as f:
+        f.write(data)
+    layers = common.readPSD(psdfile)
+    assert [x[0] for x in layers] == ["layer"]
+    image = layers[0][1]
+    assert image.size == (8, 4)
+    assert image.getpixel((0, 0)) == (0, 0, 0, 0)
+    assert [image.getpixel((x, 1)) for x in range(1, 5)] == [(0x10, 0x20, 5, 255), (0x10, 0x20, 6, 255), (0x10, 0x20, 7, 255), (0x10, 0x20, 8, 255)]
+    assert [image.getpixel((x, 2)) for x in range(1, 5)] == [(1, 0x30, 0x40, 0), (2, 0x30, 0x40, 0x80), (3, 0x30, 0x40, 255), (4, 0x30, 0x40, 255)]
@@ -0,0 +1,77 @@
+import os
+import struct
+from hacktools import cmp_cri, cpk
+
+
+def makeUTF(columns, rows):
+    # columns is a list of (name, type, constant), with constant set to None for per-row columns
+    strings = b"<NULL>\x00"
+    stringoffsets = {}
+
+    def addString(string):
+        nonlocal strings
+        if string not in stringoffsets:
+            stringoffsets[string] = len(strings)
+            strings += string.encode("ascii") + b"\x00"
+        return stringoffsets[string]
+
+    def packValue(type, value):
+        if type == cpk.UTFStructTypes.DATA_TYPE_STRING:
+            value = addString(value)
+        return struct.pack(">" + cpk.UTFStructFormats[type], value)
+
+    columndata = b""
+    rowlength = 0
+    for name, type, constant in columns:
+        if constant is None:
+            columndata += struct.pack(">Bi", cpk.UTFColumnFlags.STORAGE_PERROW | type, addString(name))
+            rowlength += struct.calcsize(">" + cpk.UTFStructFormats[type])
+        else:
+            columndata += struct.pack(">Bi", cpk.UTFColumnFlags.STORAGE_CONSTANT | type, addString(name)) + packValue(type, constant)
+    rowdata = b""
+    for row in rows:
+        perrow = [column for column in columns if column[2] is None]
+        for (name, type, constant), value in zip(perrow, row):
+            rowdata += packValue(type, value)
+    rowsoffset = 32 + len(columndata)
+    stringsoffset = rowsoffset + len(rowdata)
+    dataoffset = stringsoffset + len(strings)
+    header = struct.pack(">4siiiiihhi", b"@UTF", dataoffset - 8, rowsoffset - 8, stringsoffset - 8, dataoffset - 8, 0, len(columns), rowlength, len(rows))
+    return header + columndata + rowdata + strings
+
+
+def makePacket(magic, utf):
+    return magic + struct.pack("<iq", 0xff, len(utf)) + utf
+
+
+def test_extract_compressed(tmp_path):
+    types = cpk.UTFStructTypes
+    files = [("plain.bin", b"plain data " * 30), ("packed.bin", b"compressed data " * 40)]
+    filedata = [files[0][1], cmp_cri.compressCRILAYLA(files[1][1])]
+    tocoffset = 0x100
+    contentoffset = 0x400
+    rows = []
+    offset = contentoffset - tocoffset
+    for (name, data), stored in zip(files, filedata):
+        rows.append(("", name, len(stored), len(data), offset, len(rows)))
+        offset += len(stored)
+    header = makeUTF([("TocOffset", types.DATA_TYPE_UINT64, tocoffset), ("ContentOffset", types.DATA_TYPE_UINT64, contentoffset)], [])
+    toc = makeUTF([("DirName", types.DATA_TYPE_STRING, None), ("FileName", types.DATA_TYPE_STRING, None), ("FileSize", types.DATA_TYPE_UINT32, None),
+                   ("ExtractSize", types.DATA_TYPE_UINT32, None), ("FileOffset", types.DATA_TYPE_UINT64, None), ("ID", types.DATA_TYPE_UINT32, None)], rows)
+    data = bytearray(contentoffset)
+    header = makePacket(b"CPK ", header)
+    toc = makePacket(b"TOC ", toc)
+    data[0:len(header)] = header
+    data[tocoffset:tocoffset + len(toc)] = toc
+    data += b"".join(filedata)
+    cpkfile = str(tmp_path / "test.cpk")
+    with open(cpkfile, "wb") as f:
+        f.write(data)
+    outfolder = str(tmp_path / "out") + "/"
+    guessed = []
+    cpk.extract(cpkfile, outfolder, lambda data, entry, filename: guessed.append(data) or filename)
+    for name, data in files:
+        with open(os.path.join(outfolder, name), "rb") as f:
+            assert f.read() == data
+    assert guessed == [data for name, data in files]
+    assert all(isinstance(x, bytes) for x in guessed)
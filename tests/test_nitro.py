@@ -0,0 +1,156 @@
+import pytest
+import random
+import struct
+from hacktools import common, nitro
+
+
+@pytest.fixture
+def tiledata():
+    return bytes((x * 7) & 0xff for x in range(64 * 4))
+
+
+@pytest.mark.parametrize("bpp", [4, 8])
+def test_unpack_tiles(monkeypatch, tiledata, bpp):
+    if not common.hasNumpy:
+        pytest.skip("numpy not found")
+    tilenum = len(tiledata) * 8 // (64 * bpp)
+    monkeypatch.setattr(common, "hasNumpy", False)
+    expected = nitro.unpackTiles(tiledata, bpp, tilenum)
+    monkeypatch.setattr(common, "hasNumpy", True)
+    tiles = nitro.unpackTiles(tiledata, bpp, tilenum)
+    assert isinstance(tiles, nitro.NCGRTiles)
+    assert len(tiles) == tilenum
+    assert [list(tile) for tile in tiles] == expected
+    assert tiles[1] == expected[1]
+    assert tiles[1][5] == expected[1][5]
+    assert tiles[-1] == expected[-1]
+    assert tiles[1:3] == expected[1:3]
+    assert tiles == expected
+
+
+@pytest.mark.parametrize("bpp", [4, 8])
+def test_ncgr_tiles_write(tiledata, bpp):
+    if not common.hasNumpy:
+        pytest.skip("numpy not found")
+    tiles = nitro.unpackTiles(tiledata, bpp, 2)
+    tiles[0][3] = 9
+    assert tiles[0][3] == 9
+    assert tiles.data[0, 0, 3] == 9
+    tile = tiles[1]
+    tile[63] = 1
+    assert tiles[1][63] == 1
+    tiles[1] = [2] * 64
+    assert tiles[1] == [2] * 64
+
+
+def test_ncgr_tiles_append(tiledata):
+    if not common.hasNumpy:
+        pytest.skip("numpy not found")
+    tiles = nitro.unpackTiles(tiledata, 8, 1)
+    expected = [list(tiles[0])]
+    for i in range(100):
+        tile = [(i + x) & 0xff for x in range(64)]
+        tiles.append(tile)
+        expected.append(tile)
+    assert len(tiles) == 101
+    assert tiles == expected
+    assert tiles.data.shape == (101, 8, 8)
+    tiles.extend([[3] * 64, [4] * 64])
+    expected += [[3] * 64, [4] * 64]
+    assert tiles == expected
+    assert tiles.index([3] * 64) == 101
+    with pytest.raises(ValueError):
+        tiles.index([5] * 64)
+    assert tiles.pop() == [4] * 64
+    assert tiles.pop(1) == expected[1]
+    del expected[-1]
+    del expected[1]
+    assert tiles == expected
+    added = tiles + [[6] * 64]
+    assert len(added) == len(expected) + 1 and len(tiles) == len(expected)
+    assert added[-1] == [6] * 64
+
+
+@pytest.mark.parametrize("bpp, lineal, usenscr", [(4, False, True), (8, False, True), (4, True, False), (8, False, False)])
+def test_draw_ncgr(tmp_path, monkeypatch, bpp, lineal, usenscr):
+    if not common.hasNumpy:
+        pytest.skip("numpy not found")
+    Image = pytest.importorskip("PIL.Image")
+    rand = random.Random(bpp)
+    tiledata = bytes(rand.randrange(256) for x in range(16 * 8 * bpp))
+    palettes = {x: [(rand.randrange(256), rand.randrange(256), rand.randrange(256), 255) for y in range(16)] for x in range(2)}
+    if bpp == 8:
+        palettes = {0: [(rand.randrange(256), rand.randrange(256), rand.randrange(256), 255) for y in range(256)]}
+    nscr = None
+    if usenscr:
+        nscr = nitro.NSCR()
+        for x in range(12):
+            map = nitro.Map()
+            map.tile = rand.randrange(16)
+            map.xflip = rand.random() < 0.5
+            map.yflip = rand.random() < 0.5
+            map.pal = rand.randrange(3)
+            nscr.maps.append(map)
+    images = []
+    for usenumpy in [False, True]:
+        monkeypatch.setattr(common, "hasNumpy", usenumpy)
+        ncgr = nitro.NCGR()
+        ncgr.bpp = bpp
+        ncgr.tilelen = len(tiledata)
+        ncgr.lineal = lineal
+        nitro.readNCGRTiles(ncgr, tiledata)
+        outfile = str(tmp_path / ("out" + str(usenumpy) + ".png"))
+        nitro.drawNCGR(outfile, nscr, ncgr, palettes, 32, 24)
+        with Image.open(outfile) as img:
+            images.append((img.size, img.tobytes()))
+    assert images[0] == images[1]
+
+
+def makeCell(x, y, width, height):
+    cell = nitro.Cell()
+    cell.x = x
+    cell.y = y
+    cell.width = width
+    cell.height = height
+    return cell
+
+
+def test_cell_grid():
+    grid = nitro.CellGrid(gridsize=16)
+    cell = makeCell(0, 0, 8, 8)
+    big = makeCell(20, 20, 64, 32)
+    grid.add(cell)
+    grid.add(big)
+    assert not grid.intersects(cell)
+    assert grid.intersects(makeCell(4, 4, 8, 8))
+    assert not grid.intersects(makeCell(8, 0, 8, 8))
+    assert not grid.intersects(makeCell(0, 8, 8, 8))
+    assert grid.intersects(makeCell(80, 48, 8, 8))
+    assert not grid.intersects(makeCell(84, 0, 8, 8))
+    assert grid.intersects(makeCell(2, 2, 1, 1))
+    assert not grid.intersects(makeCell(100, 100, 0, 0))
+
+
+def test_read_ncer(tmp_path):
+    # (y, x, shape, size) for each cell, all cells are 8x8 except the last
+    cells = [(0, 0, 0, 0), (4, 4, 0, 0), (0, 32, 0, 1), (0, 0, 0, 0)]
+    banks = [cells, cells, cells[:2]]
+    data = bytearray(24)
+    data += struct.pack("<HHIII", len(banks), 0, 0x10, 0, 0)
+    celloffset = 0
+    for bank in banks:
+        data += struct.pack("<HHI", len(bank), 0, celloffset)
+        celloffset += 6 * len(bank)
+    for bank in banks:
+        for i, (y, x, shape, size) in enumerate(bank):
+            data += struct.pack("<HHH", y | (shape << 14), x | (size << 14), i)
+    ncerfile = str(tmp_path / "test.ncer")
+    with open(ncerfile, "wb") as f:
+        f.write(data)
+    ncer = nitro.readNCER(ncerfile)
+    assert [bank.duplicate for bank in ncer.banks] == [False, True, False]
+    assert ncer.banks[0].layernum == 3
+    assert [cell.layer for cell in sorted(ncer.banks[0].cells, key=lambda x: x.numcell)] == [0, 1, 1, 2]
+    assert ncer.banks[2].layernum == 2
+    ncer = nitro.readNCER(ncerfile, True)
+    assert [bank.duplicate for bank in ncer.banks] == [False, False, False]